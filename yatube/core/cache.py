@@ -0,0 +1,227 @@
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from .kvstore import CLEARED, SYNC_INTERVAL, ChangeJournal
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+class SharedState(ChangeJournal):
+    """Память процесса для одного файла кэша.
+
+    Django создает свой экземпляр бэкенда в каждом потоке, а память
+    и номер последнего прочитанного изменения общие для процесса.
+    """
+
+    def __init__(self, max_entries, sync_interval):
+        super().__init__(max_entries, sync_interval)
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+def get_state(location, max_entries, sync_interval):
+    with _states_lock:
+        if location not in _states:
+            _states[location] = SharedState(max_entries, sync_interval)
+        return _states[location]
+
+
+class TwoTierCache(BaseCache):
+    """Кэш Django: LRU в памяти процесса перед общим SQLite-файлом.
+
+    Файл (LOCATION) читают и пишут все процессы узла. Каждая запись
+    добавляет номер изменения в журнал, и перед чтением процесс
+    выбрасывает из памяти ключи, измененные другими процессами после
+    прошлой проверки. Журнал читается не чаще раза в SYNC_INTERVAL
+    секунд (OPTIONS), так что инвалидация в одном воркере видна
+    остальным с такой задержкой. Попадания в память и в файл -
+    в stats().
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.path = location
+        self.changes_kept = options.get('CHANGES_KEPT', 10000)
+        self.state = get_state(
+            location, options.get('L1_MAX_ENTRIES', 1000),
+            options.get('SYNC_INTERVAL', SYNC_INTERVAL)
+        )
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Транзакции записи открываются явно (BEGIN IMMEDIATE)
+            connection = sqlite3.connect(
+                self.path, timeout=10, isolation_level=None
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache '
+                '(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)'
+            )
+            ChangeJournal.create_table(connection)
+            self._local.connection = connection
+        return connection
+
+    def stats(self):
+        state = self.state
+        return {
+            'memory_hits': state.memory_hits,
+            'shared_hits': state.shared_hits,
+            'misses': state.misses,
+            'memory_size': len(state.memory),
+        }
+
+    @contextmanager
+    def _writing(self):
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _written(self, generation, key=None, entry=None):
+        if self.state.written(generation, key, entry):
+            self._cull()
+
+    def _cull(self):
+        with self._writing() as db:
+            db.execute(
+                'DELETE FROM cache WHERE expires <= ?', (time.time(),)
+            )
+            ChangeJournal.trim(db, self.changes_kept)
+
+    def _load(self, key):
+        """(значение в pickle, срок) из памяти или файла."""
+        db = self.db
+        seen = self.state.sync(db)
+        entry = self.state.memory.get(key)
+        if entry is not None:
+            self.state.count('memory_hits')
+            return entry
+        entry = db.execute(
+            'SELECT value, expires FROM cache WHERE key = ?', (key,)
+        ).fetchone()
+        if entry is None:
+            self.state.count('misses')
+            return None
+        self.state.count('shared_hits')
+        entry = tuple(entry)
+        self.state.remember(key, entry, seen)
+        return entry
+
+    @staticmethod
+    def _alive(expires):
+        return expires is None or expires > time.time()
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        entry = self._load(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if not self._alive(expires):
+            self.state.memory.delete(key)
+            return default
+        return pickle.loads(value)
+
+    def _store(self, key, value, timeout, only_new=False):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self.get_backend_timeout(timeout)
+        with self._writing() as db:
+            if only_new:
+                row = db.execute(
+                    'SELECT expires FROM cache WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None and self._alive(row[0]):
+                    return False
+            db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires) '
+                'VALUES (?, ?, ?)',
+                (key, value, expires)
+            )
+            generation = ChangeJournal.log(db, key)
+        self._written(generation, key, (value, expires))
+        return True
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._store(key, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self._store(key, value, timeout, only_new=True)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._writing() as db:
+            touched = db.execute(
+                'UPDATE cache SET expires = ? WHERE key = ? '
+                'AND (expires IS NULL OR expires > ?)',
+                (self.get_backend_timeout(timeout), key, time.time())
+            ).rowcount
+            generation = ChangeJournal.log(db, key) if touched else None
+        self.state.memory.delete(key)
+        if generation:
+            self._written(generation)
+        return bool(touched)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._writing() as db:
+            deleted = db.execute(
+                'DELETE FROM cache WHERE key = ?', (key,)
+            ).rowcount
+            generation = ChangeJournal.log(db, key) if deleted else None
+        self.state.memory.delete(key)
+        if generation:
+            self._written(generation)
+
+    def incr(self, key, delta=1, version=None):
+        """Атомарно для всех процессов: чтение и запись в одной
+        транзакции BEGIN IMMEDIATE."""
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._writing() as db:
+            row = db.execute(
+                'SELECT value, expires FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or not self._alive(row[1]):
+                raise ValueError(f"Key '{key}' not found")
+            new_value = pickle.loads(row[0]) + delta
+            value = pickle.dumps(new_value, pickle.HIGHEST_PROTOCOL)
+            db.execute(
+                'UPDATE cache SET value = ? WHERE key = ?', (value, key)
+            )
+            generation = ChangeJournal.log(db, key)
+        self._written(generation, key, (value, row[1]))
+        return new_value
+
+    def clear(self):
+        with self._writing() as db:
+            db.execute('DELETE FROM cache')
+            generation = ChangeJournal.log(db, CLEARED)
+        self.state.memory.clear()
+        self._written(generation)
@@ -0,0 +1,13 @@
+from django.utils.functional import SimpleLazyObject
+
+from posts.follows import get_followed_ids
+
+
+def followed_ids(request):
+    """Добавляет множество id авторов, на которых подписан пользователь.
+
+    Загружается, только если шаблон к нему обратился.
+    """
+    return {
+        'followed_ids': SimpleLazyObject(lambda: get_followed_ids(request))
+    }
@@ -0,0 +1,286 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from sorl.thumbnail.kvstores.base import KVStoreBase
+
+
+class LRUCache:
+    """Ограниченный по числу ключей словарь с вытеснением LRU."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Запись журнала «очищено все»; настоящие ключи никогда не пустые
+CLEARED = ''
+# Каждые CULL_EVERY записей подрезается журнал (и чистится кэш)
+CULL_EVERY = 1000
+# Как часто процесс читает журнал, секунд: между проверками чтения
+# из памяти не ходят в файл, а изменения других процессов видны
+# с такой задержкой
+SYNC_INTERVAL = 0.01
+
+
+class ChangeJournal:
+    """LRU в памяти процесса, согласованный с SQLite-файлом, который
+    пишут несколько процессов.
+
+    Каждая запись в файл добавляет номер изменения в таблицу changes,
+    а перед чтением из памяти процесс выбрасывает ключи, измененные
+    другими процессами после прошлой проверки.
+    """
+
+    def __init__(self, max_entries, sync_interval=SYNC_INTERVAL):
+        self.memory = LRUCache(max_entries)
+        self.seen = None
+        self.writes = 0
+        self.sync_interval = sync_interval
+        self.checked = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def create_table(db):
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS changes '
+            '(generation INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'key TEXT NOT NULL)'
+        )
+
+    @staticmethod
+    def log(db, key):
+        """Номер изменения key; вызывается в транзакции записи."""
+        return db.execute(
+            'INSERT INTO changes (key) VALUES (?)', (key,)
+        ).lastrowid
+
+    @staticmethod
+    def trim(db, kept):
+        db.execute(
+            'DELETE FROM changes WHERE generation <= '
+            '(SELECT MAX(generation) FROM changes) - ?',
+            (kept,)
+        )
+
+    def sync(self, db):
+        """Выбрасывает из памяти ключи, измененные другими процессами.
+
+        Журнал читается не чаще раза в sync_interval секунд и вне
+        блокировки: потоки процесса не ждут друг друга на запросе.
+        Возвращает номер последнего учтенного изменения.
+        """
+        now = time.monotonic()
+        with self.lock:
+            seen = self.seen
+            if seen is not None and now - self.checked < self.sync_interval:
+                return seen
+            self.checked = now
+        if seen is None:
+            row = db.execute('SELECT MAX(generation) FROM changes')
+            last = row.fetchone()[0] or 0
+            with self.lock:
+                if self.seen is None:
+                    self.seen = last
+                return self.seen
+        rows = db.execute(
+            'SELECT generation, key FROM changes WHERE generation > ? '
+            'ORDER BY generation',
+            (seen,)
+        ).fetchall()
+        with self.lock:
+            if not rows or rows[-1][0] <= self.seen:
+                # Нового нет или другой поток уже учел эти изменения
+                return self.seen
+            # Пропуск в номерах - журнал успели подрезать
+            if rows[0][0] != seen + 1 or any(
+                key == CLEARED for _, key in rows
+            ):
+                self.memory.clear()
+            else:
+                for generation, key in rows:
+                    if generation > self.seen:
+                        self.memory.delete(key)
+            self.seen = rows[-1][0]
+            return self.seen
+
+    def remember(self, key, value, seen):
+        """Кладет прочитанное из файла значение в память.
+
+        Если за время чтения другой поток продвинул журнал, изменение
+        ключа могло уже быть учтено, и старое значение осталось бы
+        в памяти навсегда. Тогда значение в память не попадает.
+        """
+        with self.lock:
+            if self.seen == seen:
+                self.memory.set(key, value)
+
+    def written(self, generation, key=None, value=None):
+        """Кладет записанное значение в память; свое изменение
+        не выбрасывает ключ из памяти при sync.
+
+        Если журнал уже учтен дальше этой записи, более новое изменение
+        ключа могло быть пропущено, и значение в память не попадает.
+        Возвращает True раз в CULL_EVERY записей: пора подрезать журнал.
+        """
+        with self.lock:
+            if self.seen is not None and generation > self.seen:
+                if value is not None:
+                    self.memory.set(key, value)
+                if generation == self.seen + 1:
+                    self.seen = generation
+            self.writes += 1
+            return self.writes % CULL_EVERY == 0
+
+
+class TieredKVStore(KVStoreBase):
+    """KV store для sorl-thumbnail: LRU в памяти процесса перед
+    локальным SQLite-файлом.
+
+    Метаданные миниатюр почти не меняются, поэтому лента из десяти
+    картинок обычно целиком читается из памяти, без запросов к БД
+    приложения. Файл общий для процессов узла: удаления и записи
+    других процессов видны через журнал изменений (ChangeJournal),
+    иначе sorl доверял бы записи о миниатюре, которую уже удалили.
+    Счетчики попаданий - в stats().
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.path = settings.THUMBNAIL_KVSTORE_PATH
+        self.journal = self.new_journal()
+        self._local = threading.local()
+        self._local.path = self.path
+        self._stats_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def new_journal():
+        return ChangeJournal(
+            settings.THUMBNAIL_KVSTORE_LRU_SIZE,
+            settings.THUMBNAIL_KVSTORE_SYNC_INTERVAL
+        )
+
+    @property
+    def db(self):
+        if self.path != settings.THUMBNAIL_KVSTORE_PATH:
+            # Файл сменили (например, в тестах): память больше не верна
+            self.path = settings.THUMBNAIL_KVSTORE_PATH
+            self.journal = self.new_journal()
+        # sqlite3-соединение нельзя делить между потоками
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.path != self.path:
+            connection.close()
+            connection = None
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS kvstore '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+            )
+            ChangeJournal.create_table(connection)
+            self._local.connection = connection
+            self._local.path = self.path
+        return connection
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_size': len(self.journal.memory),
+        }
+
+    def _get_raw(self, key):
+        db = self.db
+        journal = self.journal
+        seen = journal.sync(db)
+        value = journal.memory.get(key)
+        if value is not None:
+            self._count('memory_hits')
+            return value
+        row = db.execute(
+            'SELECT value FROM kvstore WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            self._count('misses')
+            return None
+        self._count('disk_hits')
+        journal.remember(key, row[0], seen)
+        return row[0]
+
+    def _written(self, db, generations, values):
+        journal = self.journal
+        cull = False
+        for key, generation in generations.items():
+            journal.memory.delete(key)
+            cull |= journal.written(generation, key, values.get(key))
+        if cull:
+            with db:
+                journal.trim(db, settings.THUMBNAIL_KVSTORE_CHANGES_KEPT)
+
+    def _set_raw(self, key, value):
+        db = self.db
+        # Номер изменения кладет значение в память, только если
+        # журнал уже прочитан
+        self.journal.sync(db)
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO kvstore (key, value) VALUES (?, ?)',
+                (key, value)
+            )
+            generation = ChangeJournal.log(db, key)
+        self._written(db, {key: generation}, {key: value})
+
+    def _delete_raw(self, *keys):
+        db = self.db
+        self.journal.sync(db)
+        with db:
+            db.executemany(
+                'DELETE FROM kvstore WHERE key = ?', [(key,) for key in keys]
+            )
+            generations = {key: ChangeJournal.log(db, key) for key in keys}
+        self._written(db, generations, {})
+
+    def _find_keys_raw(self, prefix):
+        rows = self.db.execute(
+            'SELECT key FROM kvstore WHERE substr(key, 1, ?) = ?',
+            (len(prefix), prefix)
+        )
+        return [key for key, in rows]
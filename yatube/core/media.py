@@ -0,0 +1,130 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import (
+    FileResponse, Http404, HttpResponse, StreamingHttpResponse
+)
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_safe
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def file_etag(stat):
+    """Сильный ETag из размера и времени изменения файла."""
+    return quote_etag(f'{stat.st_size:x}-{stat.st_mtime_ns:x}')
+
+
+def parse_range(header, size):
+    """(начало, конец) единственного диапазона байт или None.
+
+    Несколько диапазонов не поддерживаются: тогда отдается весь файл,
+    как разрешает RFC 7233. Неудовлетворимый диапазон - ValueError.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if not start:
+        # bytes=-500: последние 500 байт
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def content_type(path):
+    guessed, _ = mimetypes.guess_type(path)
+    return guessed or 'application/octet-stream'
+
+
+def read_range(path, start, length):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def sendfile_response(path, name):
+    """Пустой ответ, файл отдаст фронтовой сервер (nginx, Apache)."""
+    response = HttpResponse()
+    if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + name
+    else:
+        response['X-Sendfile'] = path
+    return response
+
+
+@require_safe
+def serve(request, path):
+    """Отдает файл из MEDIA_ROOT с кэшированием на клиенте.
+
+    ETag и Last-Modified дают ответы 304, Range - частичные ответы 206.
+    При MEDIA_SENDFILE байты отправляет фронтовой сервер, а воркер
+    Python только проверяет файл и ставит заголовки.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (OSError, SuspiciousFileOperation):
+        raise Http404('Файл не найден')
+    if not os.path.isfile(full_path):
+        raise Http404('Файл не найден')
+
+    etag = file_etag(stat)
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(stat.st_mtime)
+    )
+    if response is None:
+        response = file_response(request, full_path, path, stat, etag)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Accept-Ranges'] = 'bytes'
+    patch_cache_control(
+        response, public=True, max_age=settings.MEDIA_CACHE_MAX_AGE
+    )
+    return response
+
+
+def file_response(request, full_path, path, stat, etag):
+    if settings.MEDIA_SENDFILE:
+        # Диапазоны фронтовой сервер обработает сам
+        response = sendfile_response(full_path, path)
+        response['Content-Type'] = content_type(full_path)
+        return response
+
+    header = request.META.get('HTTP_RANGE', '')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if header and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_range(header, stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(
+                read_range(full_path, start, length), status=206
+            )
+            response['Content-Type'] = content_type(full_path)
+            response['Content-Length'] = length
+            response['Content-Range'] = (
+                f'bytes {start}-{end}/{stat.st_size}'
+            )
+            return response
+    return FileResponse(open(full_path, 'rb'))
@@ -0,0 +1,83 @@
+import functools
+import logging
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    """View выполнила больше SQL-запросов, чем ей разрешено."""
+
+
+class QueryCounter:
+    """Считает SQL-запросы внутри блока with."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._wrapper.__exit__(*exc_info)
+
+
+def query_budget(limit):
+    """Ограничивает число SQL-запросов view, включая рендер шаблона.
+
+    Число запросов сохраняется в response.query_count. При превышении
+    пишет предупреждение в лог, а при QUERY_BUDGET_RAISE = True
+    бросает QueryBudgetExceeded (так падают тесты).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with QueryCounter() as counter:
+                response = view(request, *args, **kwargs)
+            response.query_count = counter.count
+            if counter.count > limit:
+                message = (
+                    f'{view.__module__}.{view.__name__}: '
+                    f'{counter.count} SQL-запросов при бюджете {limit}'
+                )
+                if getattr(settings, 'QUERY_BUDGET_RAISE', False):
+                    raise QueryBudgetExceeded(message)
+                logger.warning(message)
+            return response
+        wrapper.query_budget = limit
+        return wrapper
+    return decorator
+
+
+class QueryBudgetTestMixin:
+    """Проверки для TestCase: view укладывается в свой бюджет,
+    и число запросов не растет вместе с числом записей на странице."""
+
+    def get_query_count(self, client, url):
+        with self.settings(QUERY_BUDGET_RAISE=True):
+            response = client.get(url)
+        self.assertTrue(
+            hasattr(response, 'query_count'),
+            f'{url}: view не обернута в query_budget'
+        )
+        return response.query_count
+
+    def assertConstantQueries(self, client, url, grow):
+        """grow() добавляет данные, которые попадут на страницу."""
+        # Первый запрос прогревает ленивые счетчики и кэши
+        client.get(url)
+        before = self.get_query_count(client, url)
+        grow()
+        after = self.get_query_count(client, url)
+        self.assertEqual(
+            before, after,
+            f'{url}: число запросов выросло с {before} до {after}'
+        )
@@ -10,11 +10,8 @@ def addclass(field, css):
 
 @register.filter
 def uglify(field):
-    x = ''
-    for i in range(len(field)):
-
-        if i % 2 == 0:
-            x += field[i].lower()
-        else:
-            x += field[i].upper()
-    return x
+    """Чередует регистр: четные символы строчные, нечетные - прописные."""
+    return ''.join(
+        char.upper() if i % 2 else char.lower()
+        for i, char in enumerate(field)
+    )
@@ -0,0 +1,267 @@
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+
+from .cache import TwoTierCache
+from .kvstore import LRUCache, TieredKVStore
+
+TEMP_DIR = tempfile.mkdtemp()
+
+
+class TestLRUCache(SimpleTestCase):
+
+    def test_evicts_least_recently_used(self):
+        """При переполнении вытесняется давно не читанный ключ"""
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+
+
+@override_settings(
+    THUMBNAIL_KVSTORE_PATH=os.path.join(TEMP_DIR, 'kvstore.sqlite3'),
+    THUMBNAIL_KVSTORE_LRU_SIZE=10,
+    THUMBNAIL_KVSTORE_SYNC_INTERVAL=0,
+)
+class TestTieredKVStore(SimpleTestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+    def test_memory_then_disk(self):
+        """Чтение идет из памяти, а после рестарта процесса - с диска"""
+        store = TieredKVStore()
+        store._set_raw('sorl-thumbnail||image||key', '{"size": [1, 1]}')
+        self.assertEqual(
+            store._get_raw('sorl-thumbnail||image||key'), '{"size": [1, 1]}'
+        )
+        self.assertEqual(store.stats()['memory_hits'], 1)
+
+        restarted = TieredKVStore()
+        restarted._get_raw('sorl-thumbnail||image||key')
+        restarted._get_raw('sorl-thumbnail||image||key')
+        self.assertIsNone(restarted._get_raw('sorl-thumbnail||image||none'))
+        self.assertEqual(
+            restarted.stats(),
+            {'memory_hits': 1, 'disk_hits': 1, 'misses': 1, 'memory_size': 1}
+        )
+        self.assertEqual(
+            restarted._find_keys_raw('sorl-thumbnail||image||'),
+            ['sorl-thumbnail||image||key']
+        )
+        restarted._delete_raw('sorl-thumbnail||image||key')
+        self.assertIsNone(restarted._get_raw('sorl-thumbnail||image||key'))
+
+    def test_memory_follows_other_processes(self):
+        """Удаление в другом процессе вытесняет запись из памяти"""
+        key = 'sorl-thumbnail||image||shared'
+        first, second = TieredKVStore(), TieredKVStore()
+        first._set_raw(key, '{"size": [1, 1]}')
+        self.assertEqual(second._get_raw(key), '{"size": [1, 1]}')
+        self.assertEqual(second._get_raw(key), '{"size": [1, 1]}')
+        first._delete_raw(key)
+        self.assertIsNone(second._get_raw(key))
+        first._set_raw(key, '{"size": [2, 2]}')
+        self.assertEqual(second._get_raw(key), '{"size": [2, 2]}')
+        second._delete_raw(key)
+
+
+@override_settings(MEDIA_ROOT=TEMP_DIR, MEDIA_SENDFILE=None)
+class TestMediaServe(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with open(os.path.join(TEMP_DIR, 'file.txt'), 'wb') as file:
+            file.write(b'0123456789')
+
+    def setUp(self):
+        self.url = reverse('media', args=['file.txt'])
+
+    def test_full_file_with_validators(self):
+        """Файл отдается с ETag и долгим кэшированием"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertIn('max-age=', response['Cache-Control'])
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_not_modified(self):
+        """Совпавший If-None-Match дает 304 без тела"""
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_byte_ranges(self):
+        """Range отдает часть файла, лишний диапазон - 416"""
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+
+    @override_settings(MEDIA_SENDFILE='x-accel-redirect')
+    def test_accel_redirect(self):
+        """Файл отдает nginx, ответ Django пустой"""
+        response = self.client.get(self.url)
+        self.assertEqual(
+            response['X-Accel-Redirect'], '/protected-media/file.txt'
+        )
+        self.assertEqual(response.content, b'')
+
+    def test_outside_media_root(self):
+        """Пути вне MEDIA_ROOT не отдаются"""
+        response = self.client.get(
+            reverse('media', args=['../settings.py'])
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class PausingDb:
+    """Останавливает поток после запроса, начинающегося с prefix."""
+
+    def __init__(self, db, prefix, paused, resume):
+        self.db = db
+        self.prefix = prefix
+        self.paused = paused
+        self.resume = resume
+
+    def execute(self, sql, *args):
+        cursor = self.db.execute(sql, *args)
+        if not sql.startswith(self.prefix):
+            return cursor
+        rows = cursor.fetchall()
+        self.paused.set()
+        self.resume.wait(5)
+        return type('Cursor', (), {
+            'fetchone': lambda self: rows[0] if rows else None,
+            'fetchall': lambda self: rows,
+        })()
+
+
+class TestTwoTierCache(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'cache.sqlite3')
+        # Журнал читается при каждом обращении, как после паузы
+        self.cache = self.open_cache(self.path)
+        self.cache.clear()
+
+    @staticmethod
+    def open_cache(path, sync_interval=0):
+        return TwoTierCache(
+            path, {'OPTIONS': {'SYNC_INTERVAL': sync_interval}}
+        )
+
+    def write_from_other_process(self, key, value):
+        key = self.cache.make_key(key)
+        with sqlite3.connect(self.path) as db:
+            db.execute(
+                'UPDATE cache SET value = ? WHERE key = ?',
+                (pickle.dumps(value), key)
+            )
+            db.execute('INSERT INTO changes (key) VALUES (?)', (key,))
+
+    def test_memory_tier_follows_other_processes(self):
+        """Изменение из другого процесса вытесняет значение из памяти"""
+        self.cache.set('key', 'old')
+        self.assertEqual(self.cache.get('key'), 'old')
+        memory_hits = self.cache.stats()['memory_hits']
+        self.write_from_other_process('key', 'new')
+        self.assertEqual(self.cache.get('key'), 'new')
+        self.assertEqual(self.cache.get('key'), 'new')
+        self.assertEqual(self.cache.stats()['memory_hits'], memory_hits + 1)
+
+    def test_add_incr_and_expiry(self):
+        """add не перезаписывает живой ключ, incr атомарен, срок истекает"""
+        self.assertTrue(self.cache.add('lock', 1))
+        self.assertFalse(self.cache.add('lock', 2))
+        self.assertEqual(self.cache.incr('lock', 5), 6)
+        with self.assertRaises(ValueError):
+            self.cache.incr('missing')
+        self.cache.set('short', 'value', -1)
+        self.assertIsNone(self.cache.get('short'))
+        self.assertTrue(self.cache.add('short', 'again'))
+
+    def test_journal_read_throttled(self):
+        """Между проверками журнала чтение идет из памяти без запроса"""
+        cache = self.open_cache(self.path + '-throttled', sync_interval=60)
+        cache.set('key', 'old')
+        self.assertEqual(cache.get('key'), 'old')
+        with sqlite3.connect(self.path + '-throttled') as db:
+            db.execute('INSERT INTO changes (key) VALUES (?)', (
+                cache.make_key('key'),
+            ))
+        self.assertEqual(cache.get('key'), 'old')
+        cache.state.checked -= 60
+        cache.get('other')
+        self.assertIsNone(cache.state.memory.get(cache.make_key('key')))
+
+    def test_journal_read_outside_lock(self):
+        """Пока один поток читает журнал, другие читают кэш"""
+        self.cache.set('key', 'value')
+        self.assertEqual(self.cache.get('key'), 'value')
+        paused, resume = threading.Event(), threading.Event()
+        reader = TwoTierCache(self.path, {})
+
+        def slow_sync():
+            reader._local.connection = PausingDb(
+                sqlite3.connect(self.path, isolation_level=None),
+                'SELECT generation', paused, resume
+            )
+            reader.get('key')
+
+        thread = threading.Thread(target=slow_sync)
+        thread.start()
+        self.assertTrue(paused.wait(5))
+        values = []
+        getter = threading.Thread(
+            target=lambda: values.append(self.cache.get('key'))
+        )
+        getter.start()
+        getter.join(5)
+        resume.set()
+        thread.join()
+        self.assertEqual(values, ['value'])
+
+    def test_stale_read_not_kept_after_concurrent_sync(self):
+        """Чтение, обогнанное sync другого потока, не оседает в памяти"""
+        self.cache.set('key', 'old')
+        self.cache.state.memory.clear()
+        read, resume = threading.Event(), threading.Event()
+        reader = TwoTierCache(self.path, {})
+
+        def slow_get():
+            reader._local.connection = PausingDb(
+                sqlite3.connect(self.path, isolation_level=None),
+                'SELECT value', read, resume
+            )
+            reader.get('key')
+
+        thread = threading.Thread(target=slow_get)
+        thread.start()
+        self.assertTrue(read.wait(5))
+        self.write_from_other_process('key', 'new')
+        self.cache.get('other')
+        resume.set()
+        thread.join()
+        self.assertEqual(self.cache.get('key'), 'new')
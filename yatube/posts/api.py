@@ -0,0 +1,164 @@
+import functools
+import os
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+from django.views.decorators.http import condition, require_safe
+
+from core.query_budget import query_budget
+from yatube.settings import NUM_PAGE_PAGINATOR
+
+from . import lookups, thumbnails
+from .cache import feed_etag, fragment_stats
+from .lookups import get_cached_or_404
+from .models import Group, Post, User
+from .paginators import CURSOR_AFTER, CURSOR_BEFORE, CursorPaginator
+from .timeline import follow_feed_keys
+
+# Поле ответа -> колонки .values(), из которых оно собирается
+FIELDS = {
+    'id': ('id',),
+    'text': ('text',),
+    'created': ('created',),
+    'author': ('author__username',),
+    'group': ('group__slug',),
+    'image': ('image',),
+    'thumbnails': ('image', 'image_hash'),
+}
+# Нужны всегда: по ним строится курсор
+KEY_COLUMNS = ('id', 'created')
+
+image_storage = Post._meta.get_field('image').storage
+
+
+class FieldsError(ValueError):
+    """В ?fields= есть неизвестные поля."""
+
+
+def parse_fields(request):
+    raw = request.GET.get('fields')
+    if not raw:
+        return list(FIELDS)
+    names = [name.strip() for name in raw.split(',') if name.strip()]
+    unknown = [name for name in names if name not in FIELDS]
+    if unknown:
+        raise FieldsError(', '.join(unknown))
+    return names
+
+
+def columns(names):
+    result = list(KEY_COLUMNS)
+    for name in names:
+        for column in FIELDS[name]:
+            if column not in result:
+                result.append(column)
+    return result
+
+
+def serialize(row, names):
+    item = {}
+    for name in names:
+        if name == 'image':
+            item[name] = (
+                image_storage.url(row['image']) if row['image'] else None
+            )
+        elif name == 'thumbnails':
+            item[name] = thumbnails.find_picture(
+                row['image'], row['image_hash']
+            ) if row['image'] else None
+        else:
+            item[name] = row[FIELDS[name][0]]
+    return item
+
+
+def cursor_page(request, rows):
+    return CursorPaginator(rows, NUM_PAGE_PAGINATOR).get_page(
+        after=request.GET.get(CURSOR_AFTER),
+        before=request.GET.get(CURSOR_BEFORE)
+    )
+
+
+def feed_response(page, rows, names):
+    return JsonResponse({
+        'results': [serialize(row, names) for row in rows],
+        'next': page.next_cursor,
+        'previous': page.previous_cursor,
+    })
+
+
+def api_view(budget):
+    """JSON-лента для мобильного клиента.
+
+    Те же ленты, что и HTML-страницы, но с пагинацией по курсору
+    (?after=, ?before=), выбором полей (?fields=id,text) и готовыми
+    ссылками на варианты картинки. Строки читаются через .values(),
+    число запросов не зависит от длины страницы. Обертка добавляет
+    GET/HEAD, бюджет запросов, ETag и ответ 400 на неизвестные поля.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                names = parse_fields(request)
+            except FieldsError as error:
+                return JsonResponse(
+                    {'error': f'Неизвестные поля: {error}'}, status=400
+                )
+            return view(request, names, *args, **kwargs)
+        return require_safe(
+            query_budget(budget)(condition(etag_func=feed_etag)(wrapper))
+        )
+    return decorator
+
+
+def post_feed(request, names, queryset):
+    page = cursor_page(request, queryset.values(*columns(names)))
+    return feed_response(page, page.object_list, names)
+
+
+@api_view(3)
+def index(request, names):
+    return post_feed(request, names, Post.objects.all())
+
+
+@api_view(4)
+def group_posts(request, names, slug):
+    group = get_cached_or_404(Group, 'slug', slug)
+    return post_feed(request, names, Post.objects.filter(group=group))
+
+
+@api_view(4)
+def profile(request, names, username):
+    author = get_cached_or_404(User, 'username', username)
+    return post_feed(request, names, Post.objects.filter(author=author))
+
+
+@api_view(5)
+def follow_index(request, names):
+    """Страница ключей из материализованной ленты, затем сами посты
+    одним запросом по id."""
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Нужна авторизация'}, status=401)
+    page = cursor_page(request, follow_feed_keys(request.user))
+    ids = [row['id'] for row in page.object_list]
+    posts = {
+        row['id']: row
+        for row in Post.objects.filter(pk__in=ids).values(*columns(names))
+    }
+    return feed_response(
+        page, [posts[pk] for pk in ids if pk in posts], names
+    )
+
+
+@require_safe
+@staff_member_required
+def stats(request):
+    """Статистика кэшей процесса, ответившего на запрос (для staff).
+
+    Числа у каждого воркера свои, поэтому в ответе есть его pid.
+    """
+    return JsonResponse({
+        'pid': os.getpid(),
+        'lookups': lookups.stats(),
+        'fragments': fragment_stats(),
+    })
@@ -0,0 +1,216 @@
+import functools
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .paginators import CURSOR_AFTER, CURSOR_BEFORE
+
+FEED_VERSION_KEY = 'posts:feed_version'
+PAGE_KEY = 'posts:page:{}:{}'
+FRAGMENT_KEY = 'posts:fragment:{}'
+FRAGMENT_LOCK_KEY = 'posts:fragment_lock:{}'
+# Как часто ждущий процесс проверяет, не готов ли фрагмент
+LOCK_POLL_INTERVAL = 0.05
+
+_stats = {'recomputes': 0, 'stale_hits': 0, 'waits': 0, 'wait_time': 0.0}
+_stats_lock = threading.Lock()
+
+
+def get_feed_version():
+    """Текущая версия лент. Входит в ключ кэша каждого фрагмента."""
+    version = cache.get(FEED_VERSION_KEY)
+    if version is None:
+        # После вытеснения ключа начинаем с метки времени, а не с 1,
+        # чтобы не попасть на старые фрагменты с той же версией.
+        version = int(time.time() * 1000)
+        cache.add(FEED_VERSION_KEY, version, None)
+        version = cache.get(FEED_VERSION_KEY, version)
+    return version
+
+
+def bump_feed_version():
+    """Сбрасывает все закэшированные фрагменты лент."""
+    try:
+        return cache.incr(FEED_VERSION_KEY)
+    except ValueError:
+        return get_feed_version()
+
+
+def feed_page_key(request):
+    """Часть ключа, зависящая от страницы или курсора."""
+    for param in (CURSOR_BEFORE, CURSOR_AFTER):
+        token = request.GET.get(param)
+        if token:
+            return f'{param}:{token}'
+    return f'page:{request.GET.get("page") or 1}'
+
+
+def feed_cache_context(request, *vary_on):
+    """Ключ для тега {% feedcache %} в шаблонах лент."""
+    return {
+        'feed_cache_key': ':'.join(
+            [feed_page_key(request)] + [str(value) for value in vary_on]
+        ),
+    }
+
+
+def _count(counter, value=1):
+    with _stats_lock:
+        _stats[counter] += value
+
+
+def fragment_stats():
+    """Пересчеты фрагментов и ожидания блокировки в этом процессе."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _store_fragment(key, version, compute):
+    value = compute()
+    cache.set(
+        FRAGMENT_KEY.format(key),
+        (version, time.time() + settings.FEED_CACHE_TIMEOUT, value),
+        settings.FEED_CACHE_TIMEOUT + settings.FEED_CACHE_GRACE
+    )
+    _count('recomputes')
+    return value
+
+
+def get_fragment(key, compute, request=None):
+    """Фрагмент ленты из кэша; устаревший пересчитывает один процесс.
+
+    Запись хранит версию лент и срок свежести. Когда запись устарела
+    (сменилась версия или вышел FEED_CACHE_TIMEOUT), пересчитывает тот,
+    кто взял короткую блокировку, а остальные до конца пересчета
+    отдают старое значение - оно живет еще FEED_CACHE_GRACE секунд.
+    Если старого значения нет, процесс ждет пересчета, но не дольше
+    FEED_CACHE_LOCK_TIMEOUT.
+
+    Старое значение прежней версии помечает request: страницу из него
+    нельзя кэшировать и отдавать с ETag новой версии (см. feed_condition
+    и cache_anonymous_page).
+    """
+    version = get_feed_version()
+    entry = cache.get(FRAGMENT_KEY.format(key))
+    if entry is not None:
+        entry_version, fresh_until, value = entry
+        if entry_version == version and time.time() < fresh_until:
+            return value
+
+    lock_key = FRAGMENT_LOCK_KEY.format(key)
+    lock_timeout = settings.FEED_CACHE_LOCK_TIMEOUT
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            return _store_fragment(key, version, compute)
+        finally:
+            cache.delete(lock_key)
+    if entry is not None:
+        _count('stale_hits')
+        if entry[0] != version and request is not None:
+            request._stale_fragment = True
+        return entry[2]
+
+    entry = _wait_for_fragment(key, version, lock_key)
+    if entry is not None:
+        return entry[2]
+    # Пересчитывающий процесс упал или не успел: считаем сами
+    return _store_fragment(key, version, compute)
+
+
+def _wait_for_fragment(key, version, lock_key):
+    """Ждет, пока другой процесс сохранит фрагмент этой версии."""
+    start = time.perf_counter()
+    try:
+        while time.perf_counter() - start < settings.FEED_CACHE_LOCK_TIMEOUT:
+            time.sleep(LOCK_POLL_INTERVAL)
+            entry = cache.get(FRAGMENT_KEY.format(key))
+            if entry is not None and entry[0] == version:
+                return entry
+            if cache.get(lock_key) is None:
+                return None
+    finally:
+        _count('waits')
+        _count('wait_time', time.perf_counter() - start)
+    return None
+
+
+def feed_etag(request, *args, **kwargs):
+    """ETag страницы ленты или поста, без запросов к БД.
+
+    Меняется вместе с версией лент (ее поднимают сигналы) и зависит
+    от пользователя, его CSRF-cookie (токен в форме комментария) и
+    пути с параметрами.
+    """
+    parts = (
+        get_feed_version(),
+        request.user.pk or '',
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+        request.get_full_path(),
+    )
+    return hashlib.md5(
+        ':'.join(str(part) for part in parts).encode()
+    ).hexdigest()
+
+
+def feed_condition(view):
+    """condition(etag_func=feed_etag) для страниц с фрагментами лент.
+
+    Страница, собранная из фрагмента прежней версии, уходит без ETag
+    и с no-cache: иначе клиент получал бы 304 на старое содержимое,
+    пока версия лент не сменится снова.
+    """
+    conditional = condition(etag_func=feed_etag)(view)
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = conditional(request, *args, **kwargs)
+        if getattr(request, '_stale_fragment', False):
+            del response['ETag']
+            patch_cache_control(response, no_cache=True)
+        return response
+    return wrapper
+
+
+def cache_anonymous_page(view):
+    """Кэширует целую страницу для анонимных GET-запросов.
+
+    Ключ - версия лент и путь с параметрами запроса, поэтому сигналы
+    Post, Comment, Follow и Group сбрасывают и эти страницы.
+    Авторизованные пользователи видят свое меню и формы и идут мимо
+    кэша. Ответы с cookie, CSRF-токеном или устаревшим фрагментом
+    не кэшируются.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if (
+            request.method not in ('GET', 'HEAD')
+            or request.user.is_authenticated
+        ):
+            return view(request, *args, **kwargs)
+        path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+        key = PAGE_KEY.format(get_feed_version(), path)
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+        response = view(request, *args, **kwargs)
+        if (
+            response.status_code == 200
+            and not response.streaming
+            and not response.cookies
+            and not request.META.get('CSRF_COOKIE_USED')
+            and not getattr(request, '_stale_fragment', False)
+        ):
+            cache.set(
+                key,
+                (response.content, response['Content-Type']),
+                settings.PAGE_CACHE_TIMEOUT
+            )
+        return response
+    return wrapper
@@ -0,0 +1,182 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from .models import Comment, Counter, Follow, Post
+
+POSTS = 'posts'
+GROUP_POSTS = 'group_posts'
+AUTHOR_POSTS = 'author_posts'
+POST_COMMENTS = 'post_comments'
+FOLLOWERS = 'followers'
+FOLLOWING = 'following'
+IMAGE_REFS = 'image_refs'
+
+BATCH_SIZE = 500
+
+# Счетчик -> (выборка для пересчета, поле группировки)
+SOURCES = {
+    POSTS: (Post.objects, None),
+    GROUP_POSTS: (Post.objects, 'group_id'),
+    AUTHOR_POSTS: (Post.objects, 'author_id'),
+    POST_COMMENTS: (Comment.objects, 'post_id'),
+    FOLLOWERS: (Follow.objects, 'author_id'),
+    FOLLOWING: (Follow.objects, 'user_id'),
+    IMAGE_REFS: (Post.objects.exclude(image=''), 'image'),
+}
+
+
+def counter_name(kind, pk=None):
+    return kind if pk is None else f'{kind}:{pk}'
+
+
+def _recount(kind, pk=None):
+    manager, field = SOURCES[kind]
+    if field is None:
+        return manager.count()
+    return manager.filter(**{field: pk}).count()
+
+
+def _initialize(kind, pk=None):
+    """Создает отсутствующий счетчик по реальному числу строк."""
+    name = counter_name(kind, pk)
+    try:
+        with transaction.atomic():
+            return Counter.objects.create(
+                name=name, value=_recount(kind, pk)
+            ).value
+    except IntegrityError:
+        # Счетчик успел создать параллельный запрос
+        return Counter.objects.get(name=name).value
+
+
+def get_count(kind, pk=None):
+    """Значение счетчика без записи в базу.
+
+    Счетчики заполняет миграция (reconcile), а дальше их ведут
+    сигналы. Отсутствующий счетчик (нулевой или после bulk_create)
+    пересчитывается запросом COUNT, но не создается: запись
+    на GET-запросе стоила бы транзакции.
+    """
+    value = Counter.objects.filter(
+        name=counter_name(kind, pk)
+    ).values_list('value', flat=True).first()
+    if value is None:
+        value = _recount(kind, pk)
+    return value
+
+
+def get_counts(kind, pks):
+    """Значения счетчика для нескольких объектов одним запросом;
+    отсутствующие пересчитываются еще одним, общим."""
+    names = {counter_name(kind, pk): pk for pk in pks}
+    counts = {
+        names[name]: value
+        for name, value in Counter.objects.filter(
+            name__in=names
+        ).values_list('name', 'value')
+    }
+    missing = [pk for pk in names.values() if pk not in counts]
+    if missing:
+        manager, field = SOURCES[kind]
+        counts.update(dict.fromkeys(missing, 0))
+        counts.update(manager.order_by().filter(
+            **{f'{field}__in': missing}
+        ).values(field).annotate(total=Count('pk')).values_list(
+            field, 'total'
+        ))
+    return counts
+
+
+def locked_count(kind, pk=None):
+    """Значение счетчика, строка которого заблокирована до конца
+    текущей транзакции (select_for_update): параллельный change()
+    того же счетчика ждет ее коммита."""
+    value = Counter.objects.select_for_update().filter(
+        name=counter_name(kind, pk)
+    ).values_list('value', flat=True).first()
+    if value is None:
+        value = _recount(kind, pk)
+    return value
+
+
+def get_values(*keys):
+    """Значения счетчиков разных видов одним запросом.
+
+    keys - пары (вид, pk); значения возвращаются в том же порядке.
+    """
+    names = [counter_name(kind, pk) for kind, pk in keys]
+    stored = dict(Counter.objects.filter(
+        name__in=names
+    ).values_list('name', 'value'))
+    return [
+        stored[name] if name in stored else _recount(kind, pk)
+        for name, (kind, pk) in zip(names, keys)
+    ]
+
+
+def pks_above(kind, value):
+    """id объектов, у которых счетчик вида kind больше value."""
+    prefix = counter_name(kind, '')
+    return {
+        int(name[len(prefix):])
+        for name in Counter.objects.filter(
+            name__startswith=prefix, value__gt=value
+        ).values_list('name', flat=True)
+    }
+
+
+def change(kind, pk=None, delta=1):
+    """Атомарно меняет счетчик.
+
+    Вызывается после изменения строк, поэтому отсутствующий счетчик
+    заполняется пересчетом, который уже учитывает это изменение.
+    """
+    if kind != POSTS and pk is None:
+        return
+    updated = Counter.objects.filter(
+        name=counter_name(kind, pk)
+    ).update(value=F('value') + delta)
+    if not updated:
+        _initialize(kind, pk)
+
+
+def drop(kind, pk):
+    """Удаляет счетчик удаленного объекта."""
+    Counter.objects.filter(name=counter_name(kind, pk)).delete()
+
+
+def reconcile(sources=None, counter_model=Counter):
+    """Пересчитывает все счетчики по данным.
+
+    Миграции передают выборки и модель Counter из своего состояния.
+    Возвращает число исправленных счетчиков.
+    """
+    actual = {}
+    for kind, (manager, field) in (sources or SOURCES).items():
+        if field is None:
+            actual[counter_name(kind)] = manager.count()
+            continue
+        rows = manager.order_by().exclude(**{f'{field}__isnull': True}).values(
+            field
+        ).annotate(total=Count('pk')).values_list(field, 'total')
+        for pk, total in rows.iterator():
+            actual[counter_name(kind, pk)] = total
+
+    fixed = 0
+    with transaction.atomic():
+        existing = dict(counter_model.objects.values_list('name', 'value'))
+        missing = []
+        for name, value in existing.items():
+            value_now = actual.pop(name, 0)
+            if value_now != value:
+                counter_model.objects.filter(name=name).update(
+                    value=value_now
+                )
+                fixed += 1
+        for name, value in actual.items():
+            # Нулевой счетчик не нужен: отсутствующий пересчитывается
+            if value:
+                missing.append(counter_model(name=name, value=value))
+        counter_model.objects.bulk_create(missing, batch_size=BATCH_SIZE)
+        fixed += len(missing)
+    return fixed
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Follow
+
+FOLLOWS_KEY = 'posts:follows:{}'
+
+
+def followed_ids(user_id):
+    """id авторов, на которых подписан пользователь, через кэш."""
+    key = FOLLOWS_KEY.format(user_id)
+    ids = cache.get(key)
+    if ids is None:
+        ids = frozenset(Follow.objects.filter(
+            user_id=user_id
+        ).values_list('author_id', flat=True))
+        cache.set(key, ids, settings.FOLLOWS_CACHE_TIMEOUT)
+    return ids
+
+
+def get_followed_ids(request):
+    """Подписки пользователя запроса, загруженные один раз за запрос.
+
+    Проверка «подписан ли» на странице - поиск в множестве, а не
+    запрос к Follow для каждого автора.
+    """
+    if not request.user.is_authenticated:
+        return frozenset()
+    ids = getattr(request, '_followed_ids', None)
+    if ids is None:
+        ids = request._followed_ids = followed_ids(request.user.pk)
+    return ids
+
+
+def invalidate(user_id):
+    cache.delete(FOLLOWS_KEY.format(user_id))
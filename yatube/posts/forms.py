@@ -1,4 +1,7 @@
 from django import forms
+from django.core.files.uploadedfile import UploadedFile
+
+from .images import normalize_image
 from .models import Post, Comment
 
 
@@ -7,6 +10,13 @@ class PostForm(forms.ModelForm):
         model = Post
         fields = ['text', 'group', 'image']
 
+    def clean_image(self):
+        image = self.cleaned_data.get('image')
+        # При правке без новой загрузки здесь уже сохраненный файл
+        if isinstance(image, UploadedFile):
+            image = normalize_image(image)
+        return image
+
 
 class CommentForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,172 @@
+import base64
+import io
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import UploadedFile
+from PIL import Image, ImageOps, ImageSequence
+
+# Форматы, которые хранятся как есть; остальные перекодируются
+CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+}
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp'}
+EXIF_ORIENTATION = 0x0112
+# Заглушка в пропорциях кадра ленты 960x339
+PLACEHOLDER_SIZE = (24, 8)
+PLACEHOLDER_QUALITY = 40
+
+
+def _output_format(image):
+    if image.format in CONTENT_TYPES:
+        return image.format
+    has_alpha = 'A' in image.mode or 'transparency' in image.info
+    return 'PNG' if has_alpha else 'JPEG'
+
+
+def _save_options(image, image_format):
+    options = {}
+    icc_profile = image.info.get('icc_profile')
+    if icc_profile and image_format != 'GIF':
+        options['icc_profile'] = icc_profile
+    if image_format in ('JPEG', 'WEBP'):
+        options['quality'] = settings.IMAGE_QUALITY
+    if image_format in ('JPEG', 'PNG'):
+        options['optimize'] = True
+    return options
+
+
+def _open(upload):
+    """Открывает картинку, проверяя размер по заголовку."""
+    upload.seek(0)
+    try:
+        image = Image.open(upload)
+    except Image.DecompressionBombError:
+        raise ValidationError('Слишком большая картинка.')
+    except OSError:
+        raise ValidationError('Не удалось прочитать картинку.')
+    width, height = image.size
+    if width * height > settings.IMAGE_MAX_PIXELS:
+        raise ValidationError(
+            'Слишком большая картинка: %(width)sx%(height)s.',
+            params={'width': width, 'height': height}
+        )
+    return image
+
+
+def _normalize_animation(upload, image, oversized):
+    """Уменьшает анимацию покадрово; подходящая по размеру хранится
+    как есть, чтобы не терять качество при перекодировании.
+
+    Распаковывается каждый кадр, поэтому IMAGE_MAX_PIXELS
+    ограничивает сумму пикселей всех кадров.
+    """
+    if not oversized:
+        upload.seek(0)
+        return upload
+    width, height = image.size
+    if width * height * image.n_frames > settings.IMAGE_MAX_PIXELS:
+        raise ValidationError(
+            'Слишком большая анимация: %(width)sx%(height)s, '
+            'кадров: %(frames)s.',
+            params={
+                'frames': image.n_frames, 'width': width, 'height': height
+            }
+        )
+    max_size = settings.IMAGE_MAX_SIZE
+    frames, durations = [], []
+    try:
+        for frame in ImageSequence.Iterator(image):
+            durations.append(frame.info.get('duration', 0))
+            frame = frame.convert('RGBA')
+            frame.thumbnail((max_size, max_size), Image.LANCZOS)
+            frames.append(frame)
+    except OSError:
+        raise ValidationError('Не удалось прочитать картинку.')
+
+    output = tempfile.SpooledTemporaryFile(
+        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+    )
+    frames[0].save(
+        output, image.format, save_all=True, append_images=frames[1:],
+        duration=durations, loop=image.info.get('loop', 0), disposal=2
+    )
+    size = output.tell()
+    output.seek(0)
+    name = os.path.splitext(upload.name)[0] + EXTENSIONS[image.format]
+    return UploadedFile(output, name, CONTENT_TYPES[image.format], size)
+
+
+def normalize_image(upload):
+    """Готовит загруженную картинку к хранению.
+
+    Размер проверяется по заголовку, до распаковки пикселей. Картинка
+    поворачивается по EXIF, уменьшается до IMAGE_MAX_SIZE и
+    перекодируется без метаданных; анимация уменьшается покадрово.
+    Уже подходящая картинка возвращается без изменений. Большие
+    загрузки Django держит во временном файле, результат тоже пишется
+    в файл, а не в память, если он больше FILE_UPLOAD_MAX_MEMORY_SIZE.
+    """
+    image = _open(upload)
+    width, height = image.size
+    max_size = settings.IMAGE_MAX_SIZE
+    oversized = max(width, height) > max_size
+    rotated = image.getexif().get(EXIF_ORIENTATION, 1) != 1
+    image_format = _output_format(image)
+    unchanged = not (
+        oversized or rotated or 'exif' in image.info
+    ) and image_format == image.format
+    if unchanged:
+        upload.seek(0)
+        return upload
+    if getattr(image, 'is_animated', False):
+        return _normalize_animation(upload, image, oversized)
+
+    if image.format == 'JPEG':
+        # JPEG распаковывается сразу в уменьшенном в 2-8 раз виде
+        image.draft('RGB', (max_size, max_size))
+    try:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+    except OSError:
+        raise ValidationError('Не удалось прочитать картинку.')
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.info.pop('exif', None)
+
+    output = tempfile.SpooledTemporaryFile(
+        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+    )
+    image.save(output, image_format, **_save_options(image, image_format))
+    size = output.tell()
+    output.seek(0)
+    name = os.path.splitext(upload.name)[0] + EXTENSIONS[image_format]
+    return UploadedFile(output, name, CONTENT_TYPES[image_format], size)
+
+
+def placeholder(file):
+    """Крошечная JPEG-копия картинки в data URI.
+
+    Около полукилобайта; шаблон показывает ее размытой, пока грузится
+    сама картинка. Для нечитаемого файла - пустая строка.
+    """
+    file.seek(0)
+    try:
+        image = Image.open(file)
+        width, height = PLACEHOLDER_SIZE
+        image.draft('RGB', (width * 4, height * 4))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image = ImageOps.fit(image, PLACEHOLDER_SIZE, Image.BILINEAR)
+    except OSError:
+        return ''
+    finally:
+        file.seek(0)
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=PLACEHOLDER_QUALITY)
+    encoded = base64.b64encode(output.getvalue()).decode()
+    return f'data:image/jpeg;base64,{encoded}'
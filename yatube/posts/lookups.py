@@ -0,0 +1,77 @@
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+
+LOOKUP_KEY = 'posts:lookup:fields:{}:{}:{}'
+# Поля, которые кэшируются для модели (по умолчанию - все). Хэш пароля,
+# почта и флаги пользователя не попадают в общий кэш на диске
+CACHED_FIELDS = {
+    'auth.user': ('id', 'username', 'first_name', 'last_name'),
+}
+# Отметка «такого объекта нет»: None в кэше не отличить от промаха
+NOT_FOUND = 'not-found'
+
+_stats = {'hits': 0, 'negative_hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def lookup_key(model, field, value):
+    # В slug и username бывают символы, недопустимые в ключах memcached
+    digest = hashlib.md5(str(value).encode()).hexdigest()
+    return LOOKUP_KEY.format(model._meta.label_lower, field, digest)
+
+
+def _count(counter):
+    with _stats_lock:
+        _stats[counter] += 1
+
+
+def stats():
+    """Попадания в кэш поиска объектов в этом процессе."""
+    with _stats_lock:
+        result = dict(_stats)
+    total = sum(result.values())
+    result['hit_rate'] = (
+        (result['hits'] + result['negative_hits']) / total if total else 0
+    )
+    return result
+
+
+def cached_fields(model):
+    return CACHED_FIELDS.get(model._meta.label_lower) or tuple(
+        field.attname for field in model._meta.concrete_fields
+    )
+
+
+def get_cached_or_404(model, field, value):
+    """get_object_or_404 по уникальному полю через кэш.
+
+    В кэше лежат только значения cached_fields(model), из них
+    собирается объект с отложенными остальными полями. Отсутствие
+    объекта тоже кэшируется, но ненадолго. Сигналы сохранения
+    и удаления сбрасывают ключ (см. invalidate_lookups).
+    """
+    key = lookup_key(model, field, value)
+    fields = cached_fields(model)
+    manager = model._default_manager
+    values = cache.get(key)
+    if values == NOT_FOUND:
+        _count('negative_hits')
+        raise Http404(f'{model._meta.verbose_name} не найден')
+    if values is not None:
+        _count('hits')
+        return model.from_db(manager.db, fields, values)
+    _count('misses')
+    values = manager.filter(**{field: value}).values_list(*fields).first()
+    if values is None:
+        cache.set(key, NOT_FOUND, settings.LOOKUP_NEGATIVE_CACHE_TIMEOUT)
+        raise Http404(f'{model._meta.verbose_name} не найден')
+    cache.set(key, values, settings.LOOKUP_CACHE_TIMEOUT)
+    return model.from_db(manager.db, fields, values)
+
+
+def invalidate(model, field, *values):
+    cache.delete_many([lookup_key(model, field, value) for value in values])
@@ -0,0 +1,193 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import (
+    DEFAULT_DB_ALIAS, connection, connections, transaction
+)
+from django.db.models import Count
+
+from posts.models import Comment, Follow, Post, TimelineEntry
+from yatube.settings import NUM_PAGE_PAGINATOR
+
+
+class Rollback(Exception):
+    """Откатывает временное удаление индексов на копии базы."""
+
+
+class Command(BaseCommand):
+    help = (
+        'Печатает план (EXPLAIN) и время запросов лент с составными '
+        'индексами и без них'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--repeat', type=int, default=50,
+            help='Сколько раз выполнять каждый запрос'
+        )
+        parser.add_argument(
+            '--scratch-database',
+            help='Псевдоним копии базы из DATABASES, на которой можно '
+                 'временно удалить индексы. Без него на SQLite индексы '
+                 'обходятся подсказками, на других СУБД замеры без '
+                 'индексов пропускаются'
+        )
+
+    def busiest(self, queryset, field):
+        """Объект с наибольшим числом строк - худший случай для ленты."""
+        row = queryset.exclude(**{f'{field}__isnull': True}).values(
+            field
+        ).annotate(total=Count('pk')).order_by('-total').first()
+        return row[field] if row else None
+
+    def feed_queries(self):
+        """Запросы лент: имя -> (запрос, столбец фильтра).
+
+        По столбцу фильтра выбирается простой индекс внешнего ключа,
+        которым база пользовалась бы без составных индексов.
+        """
+        page = slice(0, NUM_PAGE_PAGINATOR)
+        queries = {
+            'index': (Post.objects.select_related(
+                'group', 'author'
+            ).order_by('-created', '-id')[page], None),
+        }
+        group_id = self.busiest(Post.objects, 'group_id')
+        if group_id:
+            queries['group_posts'] = (Post.objects.select_related(
+                'author'
+            ).filter(group_id=group_id).order_by(
+                '-created', '-id'
+            )[page], 'group_id')
+        author_id = self.busiest(Post.objects, 'author_id')
+        if author_id:
+            queries['profile'] = (Post.objects.select_related(
+                'group'
+            ).filter(author_id=author_id).order_by(
+                '-created', '-id'
+            )[page], 'author_id')
+        user_id = self.busiest(Follow.objects, 'user_id')
+        if user_id:
+            queries['follow_index'] = (TimelineEntry.objects.select_related(
+                'post__group', 'post__author'
+            ).filter(user_id=user_id).order_by(
+                '-created', '-post_id'
+            )[page], 'user_id')
+        post_id = self.busiest(Comment.objects, 'post_id')
+        if post_id:
+            queries['post_detail comments'] = (
+                Comment.objects.select_related('author').filter(
+                    post_id=post_id
+                ).order_by('-created')[page],
+                'post_id'
+            )
+        return queries
+
+    @staticmethod
+    def timed(cursor, sql, params, repeat):
+        """Среднее время запроса в мс; строки читаются, но объекты
+        моделей не строятся, чтобы оба замера были сравнимы."""
+        start = time.perf_counter()
+        for _ in range(repeat):
+            cursor.execute(sql, params)
+            cursor.fetchall()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    def measure(self, queries, repeat, using=DEFAULT_DB_ALIAS):
+        results = {}
+        with connections[using].cursor() as cursor:
+            for name, (queryset, _) in queries.items():
+                queryset = queryset.using(using)
+                sql, params = queryset.query.sql_with_params()
+                results[name] = (
+                    queryset.explain(),
+                    self.timed(cursor, sql, params, repeat)
+                )
+        return results
+
+    def single_column_index(self, cursor, table, column):
+        constraints = connection.introspection.get_constraints(cursor, table)
+        for name, constraint in constraints.items():
+            if (constraint['index'] and not constraint['primary_key']
+                    and constraint['columns'] == [column]):
+                return name
+        return None
+
+    def measure_with_hints(self, queries, repeat):
+        """SQLite: составные индексы обходятся подсказками INDEXED BY
+        (простой индекс фильтра) и NOT INDEXED, схема не меняется."""
+        quote = connection.ops.quote_name
+        results = {}
+        with connection.cursor() as cursor:
+            for name, (queryset, column) in queries.items():
+                table = queryset.model._meta.db_table
+                index = column and self.single_column_index(
+                    cursor, table, column
+                )
+                hint = f'INDEXED BY {quote(index)}' if index else (
+                    'NOT INDEXED'
+                )
+                sql, params = queryset.query.sql_with_params()
+                sql = sql.replace(
+                    f'FROM {quote(table)}', f'FROM {quote(table)} {hint}', 1
+                )
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                plan = '\n'.join(
+                    ' '.join(str(value) for value in row)
+                    for row in cursor.fetchall()
+                )
+                results[name] = (
+                    plan, self.timed(cursor, sql, params, repeat)
+                )
+        return results
+
+    def measure_without_indexes(self, queries, repeat, scratch):
+        """Удаляет составные индексы в транзакции на копии базы
+        (--scratch-database), меряет и откатывает.
+
+        Рабочую базу не трогает: DROP INDEX держал бы блокировку таблиц
+        лент на все время замеров. На СУБД без транзакционного DDL
+        (MySQL) этот режим пропускается.
+        """
+        scratch_connection = connections[scratch]
+        if not scratch_connection.features.can_rollback_ddl:
+            return None
+        results = None
+        try:
+            with transaction.atomic(using=scratch), \
+                    scratch_connection.cursor() as cursor:
+                for model in (Post, Comment, TimelineEntry):
+                    for index in model._meta.indexes:
+                        name = scratch_connection.ops.quote_name(index.name)
+                        cursor.execute(f'DROP INDEX {name}')
+                results = self.measure(queries, repeat, using=scratch)
+                raise Rollback
+        except Rollback:
+            pass
+        return results
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        scratch = options['scratch_database']
+        queries = self.feed_queries()
+        if scratch:
+            before = self.measure_without_indexes(queries, repeat, scratch)
+        elif connection.vendor == 'sqlite':
+            before = self.measure_with_hints(queries, repeat)
+        else:
+            before = None
+            self.stderr.write(
+                'Замеры без составных индексов пропущены: укажите '
+                '--scratch-database с копией базы'
+            )
+        after = self.measure(queries, repeat)
+        for name, (plan, elapsed) in after.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            if before is not None:
+                old_plan, old_elapsed = before[name]
+                self.stdout.write('Без составных индексов:')
+                self.stdout.write(old_plan)
+                self.stdout.write(f'{old_elapsed:.3f} мс на запрос')
+            self.stdout.write('С составными индексами:')
+            self.stdout.write(plan)
+            self.stdout.write(f'{elapsed:.3f} мс на запрос')
@@ -0,0 +1,127 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings as thumbnail_settings
+from sorl.thumbnail.images import ImageFile
+
+from posts import counters, thumbnails
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет картинки постов, на которые не ссылается ни один пост, '
+        'и миниатюры, которых нет в KV store sorl'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать, что будет удалено'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Сколько файлов проверять одним запросом'
+        )
+        parser.add_argument(
+            '--min-age', type=int, default=60 * 60,
+            help='Не трогать файлы моложе стольких секунд: их пост '
+                 'или запись в KV store может быть еще не сохранена'
+        )
+
+    def walk(self, directory):
+        """Имена файлов относительно MEDIA_ROOT, по одному."""
+        root = os.path.join(settings.MEDIA_ROOT, directory)
+        deadline = time.time() - self.min_age
+        for path, _, files in os.walk(root):
+            for filename in files:
+                full_path = os.path.join(path, filename)
+                stat = os.stat(full_path)
+                self.scanned += 1
+                if stat.st_mtime > deadline:
+                    continue
+                name = os.path.relpath(full_path, settings.MEDIA_ROOT)
+                yield name.replace(os.sep, '/'), stat.st_size
+
+    def batches(self, files):
+        batch = []
+        for item in files:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def orphaned_images(self):
+        """Картинки без постов: одна выборка по image__in на пачку."""
+        directory = Post._meta.get_field('image').upload_to
+        for batch in self.batches(self.walk(directory)):
+            referenced = set(Post.objects.filter(
+                image__in=[name for name, _ in batch]
+            ).values_list('image', flat=True))
+            yield [item for item in batch if item[0] not in referenced]
+
+    def orphaned_thumbnails(self):
+        """Миниатюры, о которых не знает KV store sorl."""
+        kvstore, storage = default.kvstore, default.storage
+        files = self.walk(thumbnail_settings.THUMBNAIL_PREFIX)
+        for batch in self.batches(files):
+            yield [
+                (name, size) for name, size in batch
+                if kvstore.get(ImageFile(name, storage)) is None
+            ]
+
+    def delete_image(self, name):
+        """Удаляет картинку, если на нее так и нет ссылок.
+
+        Как и release_image, решает под блокировкой строки счетчика
+        ссылок: файл с тем же содержимым мог достаться новому посту
+        после выборки пачки, а --min-age его не защищает - у файла
+        остается старое время изменения. Возвращает False, если
+        картинка снова используется.
+        """
+        with transaction.atomic():
+            if (
+                counters.locked_count(counters.IMAGE_REFS, name) > 0
+                or Post.objects.filter(image=name).exists()
+            ):
+                return False
+            counters.drop(counters.IMAGE_REFS, name)
+            # Вместе с картинкой уходят ее миниатюры и записи KV store
+            thumbnails.delete_image(name)
+        return True
+
+    def collect(self, batches, delete):
+        for batch in batches:
+            for name, size in batch:
+                if not self.dry_run and delete(name) is False:
+                    continue
+                self.deleted += 1
+                self.freed += size
+                if self.verbosity > 1 or self.dry_run:
+                    self.stdout.write(name)
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+        self.min_age = options['min_age']
+        self.verbosity = options['verbosity']
+        self.scanned = self.deleted = self.freed = 0
+        start = time.perf_counter()
+
+        self.collect(self.orphaned_images(), self.delete_image)
+        self.collect(self.orphaned_thumbnails(), default.storage.delete)
+
+        elapsed = time.perf_counter() - start
+        action = 'Будет удалено' if self.dry_run else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} файлов: {self.deleted} из {self.scanned} '
+            f'({self.freed / 1024 / 1024:.1f} МБ) '
+            f'за {elapsed:.1f} с, '
+            f'{self.scanned / max(elapsed, 0.001):.0f} файлов/с'
+        ))
@@ -0,0 +1,330 @@
+import csv
+import json
+import sys
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from core.templatetags.user_filters import uglify
+from posts import counters, follows, timeline
+from posts.cache import bump_feed_version
+from posts.models import Comment, Follow, Group, Post, User
+
+TYPES = ('group', 'post', 'comment', 'follow')
+# Базы, на которых reserve_post_ids выдает id без гонки с сайтом
+SUPPORTED_VENDORS = ('postgresql', 'sqlite')
+# Не больше стольких значений в одном фильтре __in: у SQLite есть
+# предел числа параметров запроса
+CHUNK_SIZE = 500
+
+
+def chunks(values, size=CHUNK_SIZE):
+    values = iter(values)
+    while True:
+        chunk = list(islice(values, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class SkipRecord(Exception):
+    """Запись нельзя импортировать: она пропускается с сообщением."""
+
+
+@contextmanager
+def keep_created(*models):
+    """bulk_create не затирает created из файла текущим временем."""
+    fields = [model._meta.get_field('created') for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    help = (
+        'Потоково импортирует группы, посты, комментарии и подписки '
+        'из JSONL или CSV пачками bulk_create'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', help='Файл с записями; - читать из stdin'
+        )
+        parser.add_argument(
+            '--format', choices=('jsonl', 'csv'), default='jsonl',
+            help='jsonl: по объекту в строке с полем type; '
+                 'csv: заголовок с именами полей, тип задает --type'
+        )
+        parser.add_argument(
+            '--type', choices=TYPES,
+            help='Тип всех записей CSV-файла'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Сколько строк вставлять одной транзакцией'
+        )
+
+    def records(self, file, options):
+        if options['format'] == 'csv':
+            if not options['type']:
+                raise CommandError('Для CSV нужен --type')
+            for record in csv.DictReader(file):
+                record['type'] = options['type']
+                yield record
+            return
+        for line in file:
+            line = line.strip()
+            if line:
+                try:
+                    record = json.loads(line)
+                except ValueError as error:
+                    yield {'type': None, 'error': str(error)}
+                    continue
+                if not isinstance(record, dict):
+                    record = {'type': None, 'error': 'запись не объект'}
+                yield record
+
+    def user_id(self, username):
+        if not username:
+            raise SkipRecord('нет пользователя')
+        if username not in self.users:
+            user = User.objects.create_user(username=username)
+            self.users[username] = user.pk
+        return self.users[username]
+
+    def group_id(self, slug):
+        if not slug:
+            return None
+        if slug not in self.groups:
+            raise SkipRecord(f'нет группы {slug}')
+        return self.groups[slug]
+
+    def created(self, record):
+        value = record.get('created')
+        if not value:
+            return timezone.now()
+        created = parse_datetime(value)
+        if created is None:
+            raise SkipRecord(f'неверная дата {value}')
+        if timezone.is_naive(created):
+            created = timezone.make_aware(created)
+        return created
+
+    def add_group(self, record):
+        slug = record.get('slug')
+        if not slug:
+            raise SkipRecord('нет slug')
+        if slug in self.groups:
+            return
+        # Групп мало, а посты ссылаются на их id: создаются сразу
+        self.groups[slug] = Group.objects.create(
+            slug=slug,
+            title=record.get('title') or slug,
+            description=record.get('description') or ''
+        ).pk
+
+    def add_post(self, record):
+        text = record.get('text') or ''
+        author_id = self.user_id(record.get('author'))
+        post = Post(
+            author_id=author_id,
+            group_id=self.group_id(record.get('group')),
+            text=text,
+            text_uglified=uglify(text),
+            created=self.created(record)
+        )
+        # До вставки комментарии ссылаются на сам объект поста
+        post.import_id = str(record['id']) if record.get('id') else None
+        if post.import_id:
+            self.posts[post.import_id] = post
+        self.authors.add(author_id)
+        self.buffers[Post].append(post)
+
+    def add_comment(self, record):
+        post = self.posts.get(str(record.get('post')))
+        if post is None:
+            raise SkipRecord(f'нет поста {record.get("post")}')
+        comment = Comment(
+            author_id=self.user_id(record.get('author')),
+            text=record.get('text') or '',
+            created=self.created(record)
+        )
+        if isinstance(post, Post):
+            comment.post = post
+        else:
+            comment.post_id = post
+        self.buffers[Comment].append(comment)
+
+    def reserve_post_ids(self, count):
+        """id для пачки постов: вставка явных id нужна, потому что
+        bulk_create на SQLite не возвращает первичные ключи.
+
+        На PostgreSQL id берутся из последовательности, на SQLite -
+        сдвигом sqlite_sequence: запись в нее держит блокировку базы
+        до конца транзакции, поэтому посты, созданные на сайте во время
+        импорта, с ними не пересекаются, а id удаленных постов
+        (AUTOINCREMENT) не выдаются повторно.
+        """
+        table = Post._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+                    'FROM generate_series(1, %s)',
+                    [table, 'id', count]
+                )
+                return [pk for pk, in cursor.fetchall()]
+            cursor.execute(
+                'UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s',
+                [count, table]
+            )
+            if not cursor.rowcount:
+                # В таблицу еще ничего не вставляли
+                cursor.execute(
+                    'INSERT INTO sqlite_sequence (name, seq) '
+                    'SELECT %s, COALESCE(MAX(id), 0) + %s FROM '
+                    + connection.ops.quote_name(table),
+                    [table, count]
+                )
+            cursor.execute(
+                'SELECT seq FROM sqlite_sequence WHERE name = %s', [table]
+            )
+            last = cursor.fetchone()[0]
+        return range(last - count + 1, last + 1)
+
+    def assign_post_ids(self):
+        posts = self.buffers[Post]
+        for post, pk in zip(posts, self.reserve_post_ids(len(posts))):
+            post.id = pk
+            if post.import_id:
+                # Дальше в памяти остается только id
+                self.posts[post.import_id] = pk
+        for comment in self.buffers[Comment]:
+            if comment.post_id is None:
+                comment.post_id = comment.post.pk
+
+    def add_follow(self, record):
+        user_id = self.user_id(record.get('user'))
+        author_id = self.user_id(record.get('author'))
+        if user_id == author_id:
+            raise SkipRecord('подписка на себя')
+        self.followers.add(user_id)
+        self.buffers[Follow].append(
+            Follow(user_id=user_id, author_id=author_id)
+        )
+
+    def flush(self):
+        """Вставляет накопленное одной транзакцией: сначала посты,
+        затем ссылающиеся на них комментарии."""
+        with transaction.atomic(), keep_created(Post, Comment):
+            self.assign_post_ids()
+            self.buffers[Follow] = self.new_follows(self.buffers[Follow])
+            for model, rows in self.buffers.items():
+                if rows:
+                    model.objects.bulk_create(
+                        rows, ignore_conflicts=model is Follow
+                    )
+                    self.inserted[model] += len(rows)
+                    rows.clear()
+
+    def new_follows(self, rows):
+        """Подписки пачки без повторов и без уже существующих, чтобы
+        в отчет попало число действительно вставленных строк."""
+        if not rows:
+            return rows
+        existing = set()
+        for user_ids in chunks({row.user_id for row in rows}):
+            existing.update(Follow.objects.filter(
+                user_id__in=user_ids
+            ).values_list('user_id', 'author_id'))
+        new = []
+        for row in rows:
+            pair = (row.user_id, row.author_id)
+            if pair not in existing:
+                existing.add(pair)
+                new.append(row)
+        return new
+
+    def finish(self):
+        """Пересчитывает то, что при обычном сохранении делают сигналы."""
+        counters.reconcile()
+        affected = set(self.followers)
+        for author_ids in chunks(self.authors):
+            affected.update(Follow.objects.filter(
+                author_id__in=author_ids
+            ).values_list('user_id', flat=True))
+        for user_ids in chunks(sorted(affected)):
+            timeline.rebuild(user_ids)
+        for user_id in self.followers:
+            follows.invalidate(user_id)
+        bump_feed_version()
+
+    def handle(self, *args, **options):
+        if connection.vendor not in SUPPORTED_VENDORS:
+            raise CommandError(
+                'import_content резервирует id постов только на '
+                'PostgreSQL и SQLite, а база - '
+                f'{connection.display_name}'
+            )
+        batch_size = options['batch_size']
+        handlers = {
+            'group': self.add_group,
+            'post': self.add_post,
+            'comment': self.add_comment,
+            'follow': self.add_follow,
+        }
+        self.users = dict(User.objects.values_list('username', 'id'))
+        self.groups = dict(Group.objects.values_list('slug', 'id'))
+        # Внешний id поста -> объект до вставки, затем его id
+        self.posts = {}
+        self.authors = set()
+        self.followers = set()
+        self.buffers = {Post: [], Comment: [], Follow: []}
+        self.inserted = {Post: 0, Comment: 0, Follow: 0}
+        skipped = 0
+        start = time.perf_counter()
+
+        file = (
+            sys.stdin if options['path'] == '-'
+            else open(options['path'], encoding='utf-8', newline='')
+        )
+        try:
+            for number, record in enumerate(
+                self.records(file, options), start=1
+            ):
+                try:
+                    handler = handlers.get(record.get('type'))
+                    if handler is None:
+                        raise SkipRecord(
+                            record.get('error') or 'неизвестный type'
+                        )
+                    handler(record)
+                except SkipRecord as error:
+                    skipped += 1
+                    self.stderr.write(f'Запись {number} пропущена: {error}')
+                if sum(map(len, self.buffers.values())) >= batch_size:
+                    self.flush()
+            self.flush()
+        finally:
+            if file is not sys.stdin:
+                file.close()
+        self.finish()
+
+        elapsed = time.perf_counter() - start
+        total = sum(self.inserted.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'Постов: {self.inserted[Post]}, '
+            f'комментариев: {self.inserted[Comment]}, '
+            f'подписок: {self.inserted[Follow]}, пропущено: {skipped}. '
+            f'{total} строк за {elapsed:.1f} с, '
+            f'{total / max(elapsed, 0.001):.0f} строк/с'
+        ))
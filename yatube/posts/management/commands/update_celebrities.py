@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from posts import timeline
+
+
+class Command(BaseCommand):
+    help = (
+        'Обновляет список популярных авторов по счетчикам подписчиков '
+        'и дозаполняет ленты подписчиков выпавших из него'
+    )
+
+    def handle(self, *args, **options):
+        added, removed = timeline.update_celebrities()
+        self.stdout.write(self.style.SUCCESS(
+            f'Популярных авторов добавлено: {added}, убрано: {removed}'
+        ))
@@ -0,0 +1,47 @@
+# Generated by Django 2.2.16 on 2026-10-18 18:11
+
+from django.db import migrations, models
+
+from posts import counters
+
+
+def fill_counters(apps, schema_editor):
+    """Заполняет счетчики по данным, чтобы страницы не создавали их
+    при первом чтении."""
+    Post = apps.get_model('posts', 'Post')
+    Comment = apps.get_model('posts', 'Comment')
+    Follow = apps.get_model('posts', 'Follow')
+    counters.reconcile(
+        sources={
+            counters.POSTS: (Post.objects, None),
+            counters.GROUP_POSTS: (Post.objects, 'group_id'),
+            counters.AUTHOR_POSTS: (Post.objects, 'author_id'),
+            counters.POST_COMMENTS: (Comment.objects, 'post_id'),
+            counters.FOLLOWERS: (Follow.objects, 'author_id'),
+            counters.FOLLOWING: (Follow.objects, 'user_id'),
+        },
+        counter_model=apps.get_model('posts', 'Counter')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0007_timelineentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Counter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='Счетчик')),
+                ('value', models.IntegerField(default=0, verbose_name='Значение')),
+            ],
+            options={
+                'verbose_name': 'Счетчик',
+                'verbose_name_plural': 'Счетчики',
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
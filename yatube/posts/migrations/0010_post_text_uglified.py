@@ -0,0 +1,33 @@
+# Generated by Django 2.2.16 on 2026-10-18 18:16
+
+from django.db import migrations, models
+
+from core.templatetags.user_filters import uglify
+
+
+def fill_text_uglified(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    batch = []
+    for post in Post.objects.only('pk', 'text').iterator():
+        post.text_uglified = uglify(post.text)
+        batch.append(post)
+        if len(batch) == 1000:
+            Post.objects.bulk_update(batch, ['text_uglified'])
+            batch = []
+    Post.objects.bulk_update(batch, ['text_uglified'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0009_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='text_uglified',
+            field=models.TextField(blank=True, editable=False, verbose_name='Текст для ленты'),
+        ),
+        migrations.RunPython(fill_text_uglified, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.16 on 2026-10-18 18:23
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+from posts.storage import content_hash
+
+
+def fill_image_hash(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    posts = Post.objects.exclude(image='').only('pk', 'image')
+    for post in posts.iterator():
+        if not default_storage.exists(post.image.name):
+            continue
+        post.image_hash = content_hash(post.image)
+        post.image.close()
+        post.save(update_fields=['image_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0010_post_text_uglified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='image_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, verbose_name='Хэш картинки'),
+        ),
+        migrations.RunPython(fill_image_hash, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.16 on 2026-10-18 18:31
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+from posts.images import placeholder
+
+
+def fill_image_placeholder(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    posts = Post.objects.exclude(image='').only('pk', 'image')
+    for post in posts.iterator():
+        if not default_storage.exists(post.image.name):
+            continue
+        with post.image.open('rb') as image:
+            post.image_placeholder = placeholder(image)
+        post.save(update_fields=['image_placeholder'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0012_post_image_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='image_placeholder',
+            field=models.TextField(blank=True, editable=False, verbose_name='Заглушка картинки'),
+        ),
+        migrations.RunPython(fill_image_placeholder, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-18 18:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0013_post_image_placeholder'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='counter',
+            name='name',
+            field=models.CharField(max_length=255, unique=True, verbose_name='Счетчик'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.2.16 on 2026-10-18 20:41
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def fill_celebrities(apps, schema_editor):
+    """Переносит в таблицу авторов, которых раньше считал кэш: их посты
+    уже не раскладывались по лентам."""
+    threshold = settings.FANOUT_FOLLOWER_THRESHOLD
+    if threshold is None:
+        return
+    Follow = apps.get_model('posts', 'Follow')
+    Celebrity = apps.get_model('posts', 'Celebrity')
+    Celebrity.objects.bulk_create(
+        Celebrity(author_id=author_id)
+        for author_id in Follow.objects.values('author_id').annotate(
+            followers=Count('id')
+        ).filter(followers__gt=threshold).values_list(
+            'author_id', flat=True
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('posts', '0014_counter_name_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Celebrity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('author', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='celebrity', to=settings.AUTH_USER_MODEL, verbose_name='Автор')),
+            ],
+            options={
+                'verbose_name': 'Популярный автор',
+                'verbose_name_plural': 'Популярные авторы',
+            },
+        ),
+        migrations.RunPython(fill_celebrities, migrations.RunPython.noop),
+    ]
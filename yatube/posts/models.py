@@ -2,6 +2,8 @@ from django.db import models
 from django.contrib.auth import get_user_model
 from core.models import CreatModel
 
+from .storage import ContentAddressedStorage
+
 User = get_user_model()
 
 
@@ -44,14 +46,49 @@ class Post(CreatModel, models.Model):
     image = models.ImageField(
         'Картинка',
         upload_to='posts/',
+        storage=ContentAddressedStorage(),
         blank=True
     )
+    # sha256 содержимого картинки: ключ кэша ее вариантов (srcset)
+    image_hash = models.CharField(
+        'Хэш картинки',
+        max_length=64,
+        blank=True,
+        editable=False
+    )
+    # Размытая микрокопия картинки (data URI), видна до ее загрузки
+    image_placeholder = models.TextField(
+        'Заглушка картинки',
+        blank=True,
+        editable=False
+    )
+    # Текст после фильтра uglify, пересчитывается при каждом сохранении
+    text_uglified = models.TextField(
+        'Текст для ленты',
+        blank=True,
+        editable=False
+    )
 
     def __str__(self):
         return self.text[:15]
 
     class Meta:
         ordering = ('-created',)
+        # id в конце - разрешение совпадений для пагинации по курсору
+        indexes = [
+            models.Index(
+                fields=['-created', '-id'],
+                name='posts_post_created'
+            ),
+            models.Index(
+                fields=['author', '-created', '-id'],
+                name='posts_post_author_created'
+            ),
+            models.Index(
+                fields=['group', '-created', '-id'],
+                name='posts_post_group_created'
+            ),
+        ]
         verbose_name = 'Пост'
         verbose_name_plural = 'Посты'
 
@@ -86,6 +123,12 @@ class Comment(CreatModel, models.Model):
 
     class Meta:
         ordering = ('-created',)
+        indexes = [
+            models.Index(
+                fields=['post', '-created'],
+                name='posts_comment_post_created'
+            ),
+        ]
         verbose_name = 'Комментарий'
         verbose_name_plural = 'Комментарии'
 
@@ -104,3 +147,85 @@ class Follow(models.Model):
         related_name='following',
         verbose_name='Автор',
     )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'author'],
+                name='posts_follow_unique_user_author'
+            ),
+        ]
+
+
+class TimelineEntry(models.Model):
+    """Материализованная лента подписок: пост в ленте подписчика.
+
+    Заполняется при публикации поста (fan-out on write), поэтому
+    лента читается одним запросом по индексу (user, -created).
+    """
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='timeline',
+        verbose_name='Подписчик'
+    )
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='timeline_entries',
+        verbose_name='Пост'
+    )
+    # Копия post.created, чтобы сортировать без join
+    created = models.DateTimeField('Дата создания поста')
+
+    class Meta:
+        ordering = ('-created', '-post_id')
+        unique_together = ('user', 'post')
+        indexes = [
+            models.Index(
+                fields=['user', '-created', '-post'],
+                name='posts_timeline_user_created'
+            ),
+        ]
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Лента подписок'
+
+
+class Celebrity(models.Model):
+    """Популярный автор: его посты не раскладываются по лентам
+    подписчиков, а подмешиваются в них при чтении.
+
+    Список ведет команда update_celebrities по счетчикам подписчиков.
+    """
+
+    author = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name='celebrity',
+        verbose_name='Автор'
+    )
+
+    class Meta:
+        verbose_name = 'Популярный автор'
+        verbose_name_plural = 'Популярные авторы'
+
+
+class Counter(models.Model):
+    """Денормализованный счетчик, чтобы не считать строки COUNT(*).
+
+    Имя вида 'posts', 'group_posts:<id>', 'followers:<id>',
+    'image_refs:<файл картинки>'.
+    Поддерживается сигналами, сверяется командой reconcile_counters.
+    """
+
+    # 'image_refs:' плюс имя картинки длиной до 100 символов
+    name = models.CharField('Счетчик', max_length=255, unique=True)
+    value = models.IntegerField('Значение', default=0)
+
+    def __str__(self):
+        return f'{self.name}={self.value}'
+
+    class Meta:
+        verbose_name = 'Счетчик'
+        verbose_name_plural = 'Счетчики'
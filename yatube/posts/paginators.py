@@ -0,0 +1,164 @@
+import base64
+import binascii
+import functools
+
+from django.core.paginator import Page, Paginator
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+CURSOR_AFTER = 'after'
+CURSOR_BEFORE = 'before'
+
+
+def encode_cursor(obj):
+    """Кодирует позицию записи (created, id) в строку для URL.
+
+    Запись - объект модели или словарь из .values().
+    """
+    if isinstance(obj, dict):
+        created, pk = obj['created'], obj['id']
+    else:
+        created, pk = obj.created, obj.pk
+    raw = f'{created.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Разбирает курсор. Для битого курсора возвращает None."""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        created, pk = base64.urlsafe_b64decode(
+            padded.encode()
+        ).decode().split('|')
+        created = parse_datetime(created)
+        pk = int(pk)
+    except (ValueError, TypeError, binascii.Error, UnicodeDecodeError):
+        return None
+    if created is None:
+        return None
+    return created, pk
+
+
+class CountedPaginator(Paginator):
+    """Paginator, которому число записей передано заранее
+    (из денормализованного счетчика), без запроса COUNT(*)."""
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.known_count = count
+
+    @cached_property
+    def count(self):
+        return self.known_count
+
+
+class CursorPage(Page):
+    """Страница ленты, построенная по курсору, без COUNT(*).
+
+    Строки читаются при первом обращении к странице: если шаблон
+    отдал ленту из кэша фрагментов, запроса к базе нет.
+    """
+
+    is_cursor = True
+
+    def __init__(self, paginator, fetch):
+        # Page.__init__ не вызывается: object_list здесь свойство
+        self.paginator = paginator
+        self.number = None
+        self._fetch = fetch
+
+    @cached_property
+    def _result(self):
+        return self._fetch()
+
+    @property
+    def object_list(self):
+        return self._result[0]
+
+    def __repr__(self):
+        return f'<CursorPage of {len(self.object_list)} objects>'
+
+    def has_next(self):
+        return self._result[1]
+
+    def has_previous(self):
+        return self._result[2]
+
+    @property
+    def next_cursor(self):
+        if self.has_next() and self.object_list:
+            return encode_cursor(self.object_list[-1])
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous() and self.object_list:
+            return encode_cursor(self.object_list[0])
+        return None
+
+
+def keyset_slice(queryset, pk_field, key=None, newer=False, limit=None):
+    """Записи строго старше (или новее) ключа (created, pk_field).
+
+    Старшие записи идут по убыванию, новые - по возрастанию,
+    то есть всегда в порядке удаления от ключа.
+    """
+    if newer:
+        ordering = ('created', pk_field)
+        lookup = 'gt'
+    else:
+        ordering = ('-created', f'-{pk_field}')
+        lookup = 'lt'
+    queryset = queryset.order_by(*ordering)
+    if key:
+        created, pk = key
+        queryset = queryset.filter(
+            Q(**{f'created__{lookup}': created})
+            | Q(created=created, **{f'{pk_field}__{lookup}': pk})
+        )
+    return list(queryset[:limit])
+
+
+class CursorPaginator(Paginator):
+    """Пагинатор по ключу (created, id).
+
+    Каждая страница - один запрос по диапазону индекса, без OFFSET
+    и без подсчета общего числа записей. pk_field - поле, которое
+    разрешает совпадения по created и попадает в курсор как pk.
+    Вместо QuerySet можно передать объект с методом keyset_slice
+    (например, слияние нескольких лент).
+    """
+
+    def __init__(self, object_list, per_page, pk_field='id', **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.pk_field = pk_field
+
+    def _slice(self, key, newer, limit):
+        if hasattr(self.object_list, 'keyset_slice'):
+            return self.object_list.keyset_slice(key, newer, limit)
+        return keyset_slice(
+            self.object_list, self.pk_field, key, newer, limit
+        )
+
+    def get_page(self, after=None, before=None):
+        before_key = decode_cursor(before)
+        after_key = None if before_key else decode_cursor(after)
+        return CursorPage(
+            self, functools.partial(self._rows, after_key, before_key)
+        )
+
+    def _rows(self, after_key, before_key):
+        """(строки страницы, есть ли следующая, есть ли предыдущая)."""
+        limit = self.per_page + 1
+
+        if before_key:
+            rows = self._slice(before_key, True, limit)
+            has_previous = len(rows) > self.per_page
+            return rows[:self.per_page][::-1], True, has_previous
+
+        rows = self._slice(after_key, False, limit)
+        has_next = len(rows) > self.per_page
+        return rows[:self.per_page], has_next, after_key is not None
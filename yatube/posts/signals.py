@@ -0,0 +1,242 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from core.templatetags.user_filters import uglify
+
+from . import counters, follows, lookups, thumbnails, timeline
+from .cache import bump_feed_version
+from .images import placeholder
+from .models import Comment, Follow, Group, Post, User
+from .storage import content_hash
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_feeds(sender, **kwargs):
+    """Изменение поста, комментария или группы сбрасывает кэш лент
+    и страниц."""
+    bump_feed_version()
+
+
+@receiver(pre_save, sender=Post)
+def render_text(sender, instance, raw=False, **kwargs):
+    """Лента показывает готовый текст, а не фильтрует его при рендере."""
+    if not raw:
+        instance.text_uglified = uglify(instance.text)
+
+
+@receiver(post_save, sender=Post)
+def fan_out_post(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        timeline.fan_out_post(instance)
+
+
+@receiver(post_save, sender=Follow)
+def fill_timeline(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        timeline.add_author(instance.user_id, instance.author_id)
+        bump_feed_version()
+
+
+@receiver(post_delete, sender=Follow)
+def clean_timeline(sender, instance, **kwargs):
+    timeline.remove_author(instance.user_id, instance.author_id)
+    bump_feed_version()
+
+
+@receiver(pre_save, sender=Post)
+def remember_saved_state(sender, instance, raw=False, **kwargs):
+    """Запоминает группу и картинку до правки поста."""
+    if instance.pk and not raw:
+        saved = Post.objects.filter(pk=instance.pk).values_list(
+            'group_id', 'image'
+        ).first()
+        if saved:
+            instance._saved_group_id, instance._saved_image = saved
+
+
+@receiver(pre_save, sender=Post)
+def describe_image(sender, instance, raw=False, **kwargs):
+    """Хэш новой картинки (ключ кэша ее вариантов) и ее заглушка."""
+    if raw:
+        return
+    if not instance.image:
+        instance.image_hash = instance.image_placeholder = ''
+    elif not instance.image._committed:
+        instance.image_hash = content_hash(instance.image.file)
+        instance.image_placeholder = placeholder(instance.image.file)
+        # После сохранения поле хранит только имя, а загрузка может
+        # понадобиться track_image
+        instance._image_upload = instance.image.file
+
+
+@receiver(post_save, sender=Post)
+def count_post(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        counters.change(counters.POSTS)
+        counters.change(counters.AUTHOR_POSTS, instance.author_id)
+        counters.change(counters.GROUP_POSTS, instance.group_id)
+        return
+    saved_group_id = getattr(instance, '_saved_group_id', None)
+    if saved_group_id != instance.group_id:
+        counters.change(counters.GROUP_POSTS, saved_group_id, -1)
+        counters.change(counters.GROUP_POSTS, instance.group_id)
+    instance._saved_group_id = instance.group_id
+
+
+@receiver(post_save, sender=Post)
+def track_image(sender, instance, created, raw=False, **kwargs):
+    """Считает ссылки на файл картинки и заказывает миниатюры.
+
+    Миниатюры создаются в фоне, а не при первом рендере ленты.
+    """
+    name = instance.image.name
+    saved_name = getattr(instance, '_saved_image', None)
+    if raw or name == saved_name:
+        return
+    instance._saved_image = name
+    upload = getattr(instance, '_image_upload', None)
+    instance._image_upload = None
+    if name:
+        with transaction.atomic():
+            # change() блокирует строку счетчика до коммита, поэтому
+            # release_image не удалит файл, пока ссылка не учтена
+            counters.change(counters.IMAGE_REFS, name)
+            storage = instance.image.storage
+            if upload is not None and not storage.exists(name):
+                # Файл с тем же содержимым удалили после проверки
+                # exists() в ContentAddressedStorage.save
+                upload.seek(0)
+                storage._save(name, upload)
+        image_hash = instance.image_hash
+        transaction.on_commit(lambda: thumbnails.schedule(name, image_hash))
+    if saved_name:
+        release_image(saved_name)
+
+
+def release_image(name):
+    """Снимает ссылку на файл; последний удаляется после коммита.
+
+    Одну картинку могут делить несколько постов (хранилище
+    по хэшу содержимого), поэтому файл удаляется, только когда
+    на него не осталось ссылок.
+    """
+    counters.change(counters.IMAGE_REFS, name, -1)
+
+    def delete_if_unused():
+        # Решение и удаление - под блокировкой строки счетчика:
+        # новая ссылка из track_image ждет или видит удаление
+        with transaction.atomic():
+            if counters.locked_count(counters.IMAGE_REFS, name) <= 0:
+                counters.drop(counters.IMAGE_REFS, name)
+                thumbnails.delete_image(name)
+
+    transaction.on_commit(delete_if_unused)
+
+
+@receiver(post_delete, sender=Post)
+def uncount_post(sender, instance, **kwargs):
+    counters.change(counters.POSTS, delta=-1)
+    counters.change(counters.AUTHOR_POSTS, instance.author_id, -1)
+    counters.change(counters.GROUP_POSTS, instance.group_id, -1)
+    counters.drop(counters.POST_COMMENTS, instance.pk)
+    if instance.image:
+        release_image(instance.image.name)
+
+
+@receiver(post_delete, sender=Group)
+def uncount_group(sender, instance, **kwargs):
+    counters.drop(counters.GROUP_POSTS, instance.pk)
+
+
+@receiver(post_save, sender=Comment)
+def count_comment(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.change(counters.POST_COMMENTS, instance.post_id)
+
+
+@receiver(post_delete, sender=Comment)
+def uncount_comment(sender, instance, **kwargs):
+    counters.change(counters.POST_COMMENTS, instance.post_id, -1)
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def invalidate_follows(sender, instance, raw=False, **kwargs):
+    if not raw:
+        follows.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=Follow)
+def count_follow(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.change(counters.FOLLOWERS, instance.author_id)
+        counters.change(counters.FOLLOWING, instance.user_id)
+
+
+@receiver(post_delete, sender=Follow)
+def uncount_follow(sender, instance, **kwargs):
+    counters.change(counters.FOLLOWERS, instance.author_id, -1)
+    counters.change(counters.FOLLOWING, instance.user_id, -1)
+
+
+# Модели, которые views ищут через lookups.get_cached_or_404
+LOOKUP_FIELDS = {Group: 'slug', User: 'username'}
+# Поля, которые запоминаются до сохранения: поле поиска, а у пользователя
+# еще и имя, которое выводят ленты и страницы постов
+SAVED_FIELDS = {
+    Group: ('slug',),
+    User: ('username', 'first_name', 'last_name'),
+}
+
+
+@receiver(pre_save, sender=Group)
+@receiver(pre_save, sender=User)
+def remember_lookup_value(sender, instance, update_fields=None, **kwargs):
+    """Запоминает slug или username до переименования, а для
+    пользователя - и имя.
+
+    Вход пользователя сохраняет только last_login: лишнего запроса нет.
+    """
+    fields = SAVED_FIELDS[sender]
+    if instance.pk and (
+        update_fields is None or set(fields) & set(update_fields)
+    ):
+        saved = sender.objects.filter(pk=instance.pk).values(*fields).first()
+        if saved:
+            instance._saved_lookup_value = saved[LOOKUP_FIELDS[sender]]
+            instance._saved_public_values = saved
+
+
+@receiver(post_save, sender=User)
+def invalidate_author_pages(sender, instance, raw=False, **kwargs):
+    """Имя автора есть на страницах лент и постов: его правка
+    сбрасывает кэш страниц и ETag."""
+    saved = getattr(instance, '_saved_public_values', None)
+    instance._saved_public_values = None
+    if raw or not saved:
+        return
+    if any(
+        getattr(instance, field) != value for field, value in saved.items()
+    ):
+        bump_feed_version()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_lookups(sender, instance, **kwargs):
+    field = LOOKUP_FIELDS[sender]
+    values = {getattr(instance, field)}
+    saved_value = getattr(instance, '_saved_lookup_value', None)
+    if saved_value is not None:
+        values.add(saved_value)
+    lookups.invalidate(sender, field, *values)
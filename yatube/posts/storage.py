@@ -0,0 +1,60 @@
+import hashlib
+import os
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+HASH_NAME = re.compile('[0-9a-f]{64}')
+
+
+def content_hash(content):
+    """sha256 содержимого, читаемого по частям.
+
+    Результат запоминается на файле: сигнал и хранилище не читают
+    одну загрузку дважды.
+    """
+    digest = getattr(content, '_content_hash', None)
+    if digest is None:
+        hasher = hashlib.sha256()
+        for chunk in content.chunks():
+            hasher.update(chunk)
+        digest = content._content_hash = hasher.hexdigest()
+    return digest
+
+
+def name_hash(name):
+    """Хэш содержимого из имени файла ContentAddressedStorage.
+
+    У картинок, сохраненных до хранения по хэшу, - пустая строка.
+    """
+    digest = os.path.splitext(os.path.basename(name))[0]
+    return digest if HASH_NAME.fullmatch(digest) else ''
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранит файлы под именем из хэша содержимого.
+
+    posts/cat.jpg -> posts/ab/ab12...ef.jpg. Одинаковые загрузки
+    ложатся в один файл, а у одного файла один набор миниатюр sorl.
+    Файл удаляется, только когда на него не ссылается ни один пост
+    (см. signals.release_image).
+    """
+
+    def get_content_name(self, name, content):
+        directory, filename = os.path.split(name)
+        digest = content_hash(content)
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, digest[:2], digest + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
@@ -0,0 +1,37 @@
+from django import template
+
+from posts.cache import get_fragment
+
+register = template.Library()
+
+
+class FeedCacheNode(template.Node):
+
+    def __init__(self, nodelist, name, key):
+        self.nodelist = nodelist
+        self.name = name
+        self.key = key
+
+    def render(self, context):
+        key = f'{self.name}:{self.key.resolve(context)}'
+        return get_fragment(
+            key, lambda: self.nodelist.render(context),
+            context.get('request')
+        )
+
+
+@register.tag
+def feedcache(parser, token):
+    """{% feedcache имя ключ %}...{% endfeedcache %}
+
+    Как {% cache %}, но сбрасывается версией лент и защищен от
+    одновременного пересчета (см. posts.cache.get_fragment).
+    """
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError(
+            f'{bits[0]} принимает имя фрагмента и ключ'
+        )
+    nodelist = parser.parse(('endfeedcache',))
+    parser.delete_first_token()
+    return FeedCacheNode(nodelist, bits[1], parser.compile_filter(bits[2]))
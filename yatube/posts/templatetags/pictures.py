@@ -0,0 +1,30 @@
+from django import template
+
+from posts import thumbnails
+
+register = template.Library()
+
+SIZES = '(max-width: 960px) 100vw, 960px'
+# Размер кадра: браузер резервирует место до загрузки картинки
+WIDTH, HEIGHT = 960, 339
+
+
+@register.inclusion_tag('posts/includes/picture.html')
+def picture(image, content_hash='', placeholder='',
+            css_class='card-img my-2'):
+    """<picture> с вариантами картинки разной ширины (srcset).
+
+    Заглушка (data URI) рисуется фоном <img>, пока грузится картинка.
+    Как и {% thumbnail %}, при ошибке ничего не выводит.
+    """
+    return {
+        'picture': (
+            thumbnails.find_picture(image.name, content_hash)
+            if image else None
+        ),
+        'sizes': SIZES,
+        'placeholder': placeholder,
+        'css_class': css_class,
+        'width': WIDTH,
+        'height': HEIGHT,
+    }
@@ -0,0 +1,251 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from io import StringIO
+from unittest import mock
+
+from .. import counters
+from ..management.commands import collect_media
+from ..models import (
+    Celebrity, Counter, Follow, Post, TimelineEntry, User
+)
+
+
+class TestBackfillTimeline(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create(username='author')
+        cls.reader = User.objects.create(username='reader')
+        Follow.objects.create(user=cls.reader, author=cls.author)
+        # bulk_create не шлет сигналов, ленты остаются пустыми
+        Post.objects.bulk_create(
+            Post(text=f'Post {num}', author=cls.author) for num in range(3)
+        )
+
+    def test_backfill_timeline(self):
+        """Команда backfill_timeline восстанавливает ленты подписок"""
+        self.assertEqual(TimelineEntry.objects.count(), 0)
+        call_command('backfill_timeline', stdout=StringIO())
+        self.assertEqual(
+            set(TimelineEntry.objects.filter(
+                user=self.reader
+            ).values_list('post_id', flat=True)),
+            set(Post.objects.values_list('pk', flat=True))
+        )
+
+
+class TestUpdateCelebrities(TestCase):
+
+    @override_settings(FANOUT_FOLLOWER_THRESHOLD=1)
+    def test_update_celebrities(self):
+        """Команда update_celebrities берет порог из счетчиков"""
+        star = User.objects.create(username='star')
+        for name in ('first', 'second'):
+            Follow.objects.create(
+                user=User.objects.create(username=name), author=star
+            )
+        call_command('update_celebrities', stdout=StringIO())
+        self.assertEqual(
+            list(Celebrity.objects.values_list('author_id', flat=True)),
+            [star.pk]
+        )
+        Follow.objects.filter(user__username='first').delete()
+        # Отписка не меняет список: его меняет только команда
+        self.assertTrue(Celebrity.objects.filter(author=star).exists())
+        call_command('update_celebrities', stdout=StringIO())
+        self.assertFalse(Celebrity.objects.exists())
+
+
+class TestReconcileCounters(TestCase):
+
+    def test_reconcile_counters(self):
+        """Команда reconcile_counters исправляет расхождения"""
+        author = User.objects.create(username='author')
+        Post.objects.create(text='Post', author=author)
+        Counter.objects.filter(
+            name=counters.counter_name(counters.POSTS)
+        ).update(value=100)
+        Post.objects.bulk_create(
+            Post(text=f'Post {num}', author=author) for num in range(2)
+        )
+        call_command('reconcile_counters', stdout=StringIO())
+        self.assertEqual(counters.get_count(counters.POSTS), 3)
+        self.assertEqual(
+            counters.get_count(counters.AUTHOR_POSTS, author.pk), 3
+        )
+
+
+class TestBenchmarkFeeds(TestCase):
+
+    def test_benchmark_feeds(self):
+        """benchmark_feeds печатает планы запросов и не удаляет индексы"""
+        author = User.objects.create(username='author')
+        Post.objects.create(text='Post', author=author)
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('benchmark_feeds', repeat=1, stdout=out)
+        self.assertIn('posts_post_author_created', out.getvalue())
+        self.assertIn('Без составных индексов', out.getvalue())
+        self.assertFalse(any(
+            'DROP INDEX' in query['sql'] for query in queries
+        ))
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(
+                cursor, Post._meta.db_table
+            )
+        self.assertIn('posts_post_author_created', indexes)
+
+
+TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+
+
+@override_settings(
+    MEDIA_ROOT=TEMP_MEDIA_ROOT,
+    THUMBNAIL_KVSTORE_PATH=os.path.join(TEMP_MEDIA_ROOT, 'kvstore.sqlite3'),
+)
+class TestCollectMedia(TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def touch(self, name):
+        path = os.path.join(TEMP_MEDIA_ROOT, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(b'GIF89a')
+        return path
+
+    def test_collect_media(self):
+        """collect_media удаляет только файлы без ссылок"""
+        author = User.objects.create(username='author')
+        Post.objects.create(text='Post', author=author, image='posts/used.gif')
+        used = self.touch('posts/used.gif')
+        orphan = self.touch('posts/orphan.gif')
+        stale = self.touch('cache/aa/bb/stale.jpg')
+
+        out = StringIO()
+        call_command('collect_media', dry_run=True, min_age=0, stdout=out)
+        self.assertIn('posts/orphan.gif', out.getvalue())
+        self.assertTrue(os.path.exists(orphan))
+
+        call_command('collect_media', min_age=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(used))
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(stale))
+
+    def test_collect_media_reused_image(self):
+        """Картинка, которую после выборки пачки взял новый пост,
+        не удаляется вместе со счетчиком ссылок"""
+        author = User.objects.create(username='author')
+        reused = self.touch('posts/reused.gif')
+        command = collect_media.Command()
+        orphaned_images = command.orphaned_images
+
+        def racing_post():
+            for batch in orphaned_images():
+                Post.objects.create(
+                    text='Post', author=author, image='posts/reused.gif'
+                )
+                yield batch
+
+        command.orphaned_images = racing_post
+        call_command(command, min_age=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(reused))
+        self.assertEqual(
+            counters.get_count(counters.IMAGE_REFS, 'posts/reused.gif'), 1
+        )
+
+
+class TestImportContent(TestCase):
+
+    def test_import_content(self):
+        """import_content вставляет записи пачками и пересчитывает
+        счетчики и ленты"""
+        reader = User.objects.create(username='reader')
+        records = [
+            {'type': 'group', 'slug': 'imported', 'title': 'Импорт'},
+            {'type': 'post', 'id': 'p1', 'author': 'writer',
+             'group': 'imported', 'text': 'Первый',
+             'created': '2020-01-02T03:04:05'},
+            {'type': 'comment', 'post': 'p1', 'author': 'reader',
+             'text': 'Комментарий'},
+            {'type': 'post', 'id': 'p2', 'author': 'writer',
+             'text': 'Второй'},
+            {'type': 'comment', 'post': 'p1', 'author': 'writer',
+             'text': 'Ответ'},
+            {'type': 'comment', 'post': 'missing', 'author': 'reader',
+             'text': 'Без поста'},
+            {'type': 'follow', 'user': 'reader', 'author': 'writer'},
+            {'type': 'follow', 'user': 'reader', 'author': 'writer'},
+            [1],
+        ]
+        with tempfile.NamedTemporaryFile(
+            'w', suffix='.jsonl', encoding='utf-8', delete=False
+        ) as file:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.addCleanup(os.remove, file.name)
+
+        out, err = StringIO(), StringIO()
+        call_command(
+            'import_content', file.name, batch_size=2, stdout=out, stderr=err
+        )
+        self.assertIn('строк/с', out.getvalue())
+        self.assertIn('Запись 6 пропущена', err.getvalue())
+        self.assertIn('Запись 9 пропущена', err.getvalue())
+        self.assertIn('подписок: 1,', out.getvalue())
+        self.assertEqual(Follow.objects.filter(user=reader).count(), 1)
+
+        writer = User.objects.get(username='writer')
+        first = Post.objects.get(text='Первый')
+        self.assertEqual(first.group.slug, 'imported')
+        self.assertEqual(first.created.year, 2020)
+        self.assertEqual(first.text_uglified, 'пЕрВыЙ')
+        self.assertEqual(first.comments.count(), 2)
+        self.assertEqual(counters.get_count(counters.POSTS), 2)
+        self.assertEqual(
+            counters.get_count(counters.AUTHOR_POSTS, writer.pk), 2
+        )
+        self.assertEqual(
+            TimelineEntry.objects.filter(user=reader).count(), 2
+        )
+        # Новый пост не конфликтует с импортированными id
+        Post.objects.create(text='После импорта', author=reader)
+
+    def import_records(self, *records):
+        with tempfile.NamedTemporaryFile(
+            'w', suffix='.jsonl', encoding='utf-8', delete=False
+        ) as file:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.addCleanup(os.remove, file.name)
+        call_command('import_content', file.name, stdout=StringIO())
+
+    def test_import_content_keeps_deleted_ids(self):
+        """id удаленного последнего поста не достается импортированному"""
+        author = User.objects.create(username='writer')
+        deleted = Post.objects.create(text='Удален', author=author)
+        deleted_id = deleted.pk
+        deleted.delete()
+        self.import_records(
+            {'type': 'post', 'author': 'writer', 'text': 'Импорт'}
+        )
+        self.assertGreater(Post.objects.get(text='Импорт').pk, deleted_id)
+
+    def test_import_content_unsupported_database(self):
+        """На базах без безопасной выдачи id команда не запускается"""
+        with mock.patch.object(connections['default'], 'vendor', 'mysql'):
+            with self.assertRaisesMessage(CommandError, 'PostgreSQL'):
+                self.import_records()
+        self.assertFalse(Post.objects.exists())
@@ -1,10 +1,19 @@
+import hashlib
+import io
+import os
 import shutil
 import tempfile
+from unittest import mock
 
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase, Client, override_settings
-from ..models import Post, Group, Comment, User
+from django.test import (
+    TestCase, TransactionTestCase, Client, override_settings
+)
+from PIL import Image
+from .. import counters, thumbnails
+from ..models import Post, Group, Comment, Counter, User
+from ..storage import ContentAddressedStorage
 from django.urls import reverse
 from django.core.cache import cache
 
@@ -25,17 +34,18 @@ class PostCreateFormTest(TestCase):
         cls.auth_client = Client()
         cls.auth_client.force_login(cls.author)
 
+    small_gif = (
+        b'\x47\x49\x46\x38\x39\x61\x02\x00'
+        b'\x01\x00\x80\x00\x00\x00\x00\x00'
+        b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+        b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+        b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+        b'\x0A\x00\x3B'
+    )
+
     def setUp(self) -> None:
         cache.clear()
         self.guest_client = Client()
-        self.small_gif = (
-            b'\x47\x49\x46\x38\x39\x61\x02\x00'
-            b'\x01\x00\x80\x00\x00\x00\x00\x00'
-            b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
-            b'\x00\x00\x00\x2C\x00\x00\x00\x00'
-            b'\x02\x00\x01\x00\x00\x02\x02\x0C'
-            b'\x0A\x00\x3B'
-        )
 
     @classmethod
     def tearDownClass(cls):
@@ -74,7 +84,105 @@ class PostCreateFormTest(TestCase):
 
         self.assertEqual(post.text, form_data['text'])
         self.assertEqual(post.group.id, form_data['group'])
-        self.assertEqual(post.image, 'posts/small.gif')
+        digest = hashlib.sha256(self.small_gif).hexdigest()
+        self.assertEqual(post.image, f'posts/{digest[:2]}/{digest}.gif')
+
+    @override_settings(IMAGE_MAX_SIZE=60)
+    def test_create_post_normalizes_image(self):
+        """Картинка поворачивается по EXIF, уменьшается и теряет EXIF"""
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        photo = io.BytesIO()
+        Image.new('RGB', (300, 100)).save(photo, 'JPEG', exif=exif.tobytes())
+        uploaded = SimpleUploadedFile(
+            name='photo.jpeg',
+            content=photo.getvalue(),
+            content_type='image/jpeg'
+        )
+        self.auth_client.post(
+            reverse('posts:post_create'),
+            data={'text': 'Фото', 'image': uploaded}
+        )
+        post = Post.objects.get(text='Фото')
+        self.assertTrue(post.image.name.endswith('.jpg'))
+        with Image.open(post.image.path) as stored:
+            self.assertEqual(stored.size, (20, 60))
+            self.assertNotIn('exif', stored.info)
+
+    def animation(self, frames=3):
+        content = io.BytesIO()
+        images = [
+            Image.new('RGB', (300, 100), color)
+            for color in ('red', 'green', 'blue')[:frames]
+        ]
+        images[0].save(
+            content, 'GIF', save_all=True, append_images=images[1:],
+            duration=100, loop=0
+        )
+        return SimpleUploadedFile(
+            name='animation.gif',
+            content=content.getvalue(),
+            content_type='image/gif'
+        )
+
+    @override_settings(IMAGE_MAX_SIZE=60)
+    def test_create_post_downscales_animation(self):
+        """Большая анимация уменьшается покадрово и остается анимацией"""
+        self.auth_client.post(
+            reverse('posts:post_create'),
+            data={'text': 'Анимация', 'image': self.animation()}
+        )
+        post = Post.objects.get(text='Анимация')
+        with Image.open(post.image.path) as stored:
+            self.assertEqual(stored.size, (60, 20))
+            self.assertEqual(stored.n_frames, 3)
+
+    @override_settings(IMAGE_MAX_SIZE=60, IMAGE_MAX_PIXELS=300 * 100 * 2)
+    def test_create_post_rejects_huge_animation(self):
+        """Анимация, все кадры которой дают слишком много пикселей,
+        не принимается"""
+        response = self.auth_client.post(
+            reverse('posts:post_create'),
+            data={'text': 'Анимация', 'image': self.animation()}
+        )
+        self.assertFormError(
+            response, 'form', 'image',
+            'Слишком большая анимация: 300x100, кадров: 3.'
+        )
+
+    def test_image_placeholder(self):
+        """Заглушка считается при сохранении и выводится в ленте"""
+        post = Post.objects.create(
+            text='Заглушка',
+            author=self.author,
+            image=SimpleUploadedFile(
+                name='placeholder.gif',
+                content=self.small_gif,
+                content_type='image/gif'
+            )
+        )
+        self.assertTrue(
+            post.image_placeholder.startswith('data:image/jpeg;base64,')
+        )
+        response = self.guest_client.get(reverse('posts:index'))
+        self.assertContains(response, post.image_placeholder)
+
+    @override_settings(IMAGE_MAX_PIXELS=1)
+    def test_create_post_rejects_huge_image(self):
+        """Слишком большая по заголовку картинка не принимается"""
+        uploaded = SimpleUploadedFile(
+            name='bomb.gif',
+            content=self.small_gif,
+            content_type='image/gif'
+        )
+        response = self.auth_client.post(
+            reverse('posts:post_create'),
+            data={'text': 'Бомба', 'image': uploaded}
+        )
+        self.assertFormError(
+            response, 'form', 'image', 'Слишком большая картинка: 2x1.'
+        )
+        self.assertFalse(Post.objects.filter(text='Бомба').exists())
 
     def test_post_edit(self):
         """При отправке валидной формы создается  post_edit"""
@@ -144,3 +252,131 @@ class PostCreateFormTest(TestCase):
                 text=form_data['text']
             ).exists()
         )
+
+
+@override_settings(
+    MEDIA_ROOT=TEMP_MEDIA_ROOT,
+    THUMBNAIL_WORKERS=0,
+    THUMBNAIL_KVSTORE_PATH=os.path.join(TEMP_MEDIA_ROOT, 'kvstore.sqlite3'),
+)
+class PostThumbnailTest(TransactionTestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        # Одинаковые картинки делят миниатюры, поэтому у каждого теста
+        # свои каталог миниатюр и KV store
+        shutil.rmtree(
+            os.path.join(TEMP_MEDIA_ROOT, 'cache'), ignore_errors=True
+        )
+        kvstore = self.settings(THUMBNAIL_KVSTORE_PATH=os.path.join(
+            TEMP_MEDIA_ROOT, f'{self._testMethodName}.sqlite3'
+        ))
+        kvstore.enable()
+        self.addCleanup(kvstore.disable)
+
+    def test_thumbnails_created_on_save(self):
+        """Миниатюры создаются при сохранении поста, до рендера ленты"""
+        author = User.objects.create(username='thumbnail')
+        image = SimpleUploadedFile(
+            name='thumb.gif',
+            content=PostCreateFormTest.small_gif,
+            content_type='image/gif'
+        )
+        Post.objects.create(text='text', author=author, image=image)
+        thumbnail_dir = os.path.join(TEMP_MEDIA_ROOT, 'cache')
+        created = [
+            name for _, _, files in os.walk(thumbnail_dir) for name in files
+        ]
+        self.assertEqual(len(created), len(thumbnails.THUMBNAILS))
+
+    def test_picture_srcset_cached_by_hash(self):
+        """Лента выводит srcset вариантов, закэшированный по хэшу"""
+        cache.clear()
+        author = User.objects.create(username='srcset')
+        image = SimpleUploadedFile(
+            name='srcset.gif',
+            content=PostCreateFormTest.small_gif,
+            content_type='image/gif'
+        )
+        post = Post.objects.create(text='text', author=author, image=image)
+        self.assertEqual(
+            post.image_hash,
+            hashlib.sha256(PostCreateFormTest.small_gif).hexdigest()
+        )
+        picture = cache.get(thumbnails.PICTURE_KEY.format(post.image_hash))
+        self.assertIsNotNone(picture)
+        response = self.client.get(reverse('posts:index'))
+        for width in thumbnails.WIDTHS:
+            self.assertContains(response, f' {width}w')
+        self.assertContains(response, f'srcset="{picture["srcset"]}"')
+
+    def test_identical_images_share_one_file(self):
+        """Одинаковые картинки хранятся в одном файле до последней ссылки"""
+        author = User.objects.create(username='dedup')
+        posts = [
+            Post.objects.create(
+                text='text',
+                author=author,
+                image=SimpleUploadedFile(
+                    name=f'meme{i}.gif',
+                    content=PostCreateFormTest.small_gif,
+                    content_type='image/gif'
+                )
+            )
+            for i in range(2)
+        ]
+        name = posts[0].image.name
+        self.assertEqual(posts[1].image.name, name)
+        self.assertIn(posts[0].image_hash, name)
+        path = os.path.join(TEMP_MEDIA_ROOT, name)
+        self.assertEqual(
+            counters.get_count(counters.IMAGE_REFS, name), 2
+        )
+        picture_key = thumbnails.PICTURE_KEY.format(posts[0].image_hash)
+        self.assertIsNotNone(cache.get(picture_key))
+        posts[0].delete()
+        self.assertTrue(os.path.exists(path))
+        posts[1].delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(cache.get(picture_key))
+
+    def test_upload_restores_file_deleted_after_exists_check(self):
+        """Если файл удалили между exists() в хранилище и учетом
+        ссылки, пост сохраняет свою копию"""
+        author = User.objects.create(username='race')
+        original = ContentAddressedStorage.exists
+        # Хранилище «видит» файл, который к учету ссылки уже удален
+        answers = [True]
+
+        def exists(storage, name):
+            return answers.pop() if answers else original(storage, name)
+
+        content = io.BytesIO()
+        Image.new('RGB', (3, 1), 'red').save(content, 'GIF')
+        with mock.patch.object(ContentAddressedStorage, 'exists', exists):
+            post = Post.objects.create(
+                text='text',
+                author=author,
+                image=SimpleUploadedFile(
+                    name='race.gif',
+                    content=content.getvalue(),
+                    content_type='image/gif'
+                )
+            )
+        with open(os.path.join(TEMP_MEDIA_ROOT, post.image.name), 'rb') as f:
+            self.assertEqual(f.read(), content.getvalue())
+        self.assertEqual(
+            counters.get_count(counters.IMAGE_REFS, post.image.name), 1
+        )
+
+    def test_counter_name_fits_image_refs(self):
+        """Имя счетчика ссылок вмещает самое длинное имя картинки"""
+        self.assertGreaterEqual(
+            Counter._meta.get_field('name').max_length,
+            len(counters.counter_name(counters.IMAGE_REFS, ''))
+            + Post._meta.get_field('image').max_length
+        )
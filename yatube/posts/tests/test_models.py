@@ -1,5 +1,7 @@
+from django.db import IntegrityError
 from django.test import TestCase
-from ..models import Post, Group, User
+from ..models import Post, Group, User, Comment, Follow
+from .. import counters
 
 
 class TestModelPosts(TestCase):
@@ -26,6 +28,15 @@ class TestModelPosts(TestCase):
         group = TestModelPosts.group
         self.assertEqual(group.title, str(group))
 
+    def test_post_text_uglified(self):
+        """Текст для ленты готовится при сохранении поста."""
+        post = Post.objects.create(author=self.user, text='Hello')
+        self.assertEqual(post.text_uglified, 'hElLo')
+        post.text = 'Пост'
+        post.save()
+        post.refresh_from_db()
+        self.assertEqual(post.text_uglified, 'пОсТ')
+
     def test_posts_verbose(self):
         """verbose_name в полях совпадает с ожидаемым."""
         post = TestModelPosts.post
@@ -51,3 +62,53 @@ class TestModelPosts(TestCase):
                 self.assertEqual(
                     post._meta.get_field(field).help_text, help_text
                 )
+
+
+class TestCounters(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='auth')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.group = Group.objects.create(
+            title='Тестовая группа',
+            slug='test-slug',
+            description='Тестовое описание',
+        )
+
+    def test_counters_follow_changes(self):
+        """Счетчики меняются при создании, правке и удалении."""
+        post = Post.objects.create(
+            author=self.user, text='Тестовый пост', group=self.group
+        )
+        Comment.objects.create(post=post, author=self.reader, text='ok')
+        Follow.objects.create(user=self.reader, author=self.user)
+        expected = {
+            (counters.POSTS, None): 1,
+            (counters.AUTHOR_POSTS, self.user.pk): 1,
+            (counters.GROUP_POSTS, self.group.pk): 1,
+            (counters.POST_COMMENTS, post.pk): 1,
+            (counters.FOLLOWERS, self.user.pk): 1,
+            (counters.FOLLOWING, self.reader.pk): 1,
+        }
+        for (kind, pk), value in expected.items():
+            with self.subTest(counter=kind):
+                self.assertEqual(counters.get_count(kind, pk), value)
+
+        post.group = None
+        post.save()
+        self.assertEqual(
+            counters.get_count(counters.GROUP_POSTS, self.group.pk), 0
+        )
+        post.delete()
+        self.assertEqual(counters.get_count(counters.POSTS), 0)
+        self.assertEqual(
+            counters.get_count(counters.AUTHOR_POSTS, self.user.pk), 0
+        )
+
+    def test_follow_unique(self):
+        """Повторная подписка на того же автора запрещена."""
+        Follow.objects.create(user=self.reader, author=self.user)
+        with self.assertRaises(IntegrityError):
+            Follow.objects.create(user=self.reader, author=self.user)
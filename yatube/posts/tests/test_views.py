@@ -1,8 +1,18 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
-from ..models import Group, Post, Follow, User
+from core.query_budget import QueryBudgetTestMixin
+from .. import counters, lookups, timeline
+from ..cache import (
+    FRAGMENT_LOCK_KEY, bump_feed_version, fragment_stats, get_feed_version,
+    get_fragment
+)
+from ..models import (
+    Comment, Counter, Follow, Group, Post, TimelineEntry, User
+)
 from django import forms
 from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from yatube.settings import NUM_PAGE_PAGINATOR
 
 
@@ -35,20 +45,87 @@ class TestViews(TestCase):
 
     def test_index_cache(self):
         """Тест кэширование главной страницы"""
+        cache.clear()
         response = self.auth_client.get(reverse('posts:index'))
         posts = response.content
+        # update() не шлет сигналов: страница берется из кэша
+        Post.objects.filter(pk=TestViews.post.pk).update(text='silent_text')
+        response = self.auth_client.get(reverse('posts:index'))
+        self.assertEqual(response.content, posts)
         Post.objects.create(
             text='cache_text',
             author=TestViews.author,
             group=TestViews.group
         )
         response = self.auth_client.get(reverse('posts:index'))
-        post_new_response = response.content
-        self.assertEqual(post_new_response, posts)
-        cache.clear()
-        response = self.auth_client.get(reverse('posts:index'))
         new_response = response.content
-        self.assertNotEqual(post_new_response, new_response)
+        self.assertNotEqual(new_response, posts)
+        self.assertIn('cache_text'.encode(), new_response.lower())
+
+    def test_anonymous_page_cache(self):
+        """Анонимам страница поста отдается из кэша до изменения данных"""
+        cache.clear()
+        url = reverse(
+            'posts:post_detail', kwargs={'post_id': TestViews.post.pk}
+        )
+        page = self.client.get(url).content
+        Post.objects.filter(pk=TestViews.post.pk).update(text='silent_text')
+        response = self.client.get(url)
+        self.assertEqual(response.content, page)
+        self.assertIsNone(response.context)
+        # Авторизованный пользователь идет мимо кэша
+        response = self.auth_client.get(url)
+        self.assertContains(response, 'silent_text')
+        Comment.objects.create(
+            post=TestViews.post, author=TestViews.author, text='comment'
+        )
+        self.assertContains(self.client.get(url), 'silent_text')
+
+    def test_author_rename_resets_pages(self):
+        """Правка имени автора сбрасывает кэш страниц, вход - нет"""
+        cache.clear()
+        author = User.objects.create(username='renamed', first_name='Oldname')
+        Post.objects.create(text='Renamed post', author=author)
+        url = reverse('posts:profile', kwargs={'username': 'renamed'})
+        self.assertContains(self.client.get(url), 'Oldname')
+        version = get_feed_version()
+        Client().force_login(author)
+        self.assertEqual(get_feed_version(), version)
+        author.first_name = 'Newname'
+        author.save()
+        response = self.client.get(url)
+        self.assertContains(response, 'Newname')
+        self.assertNotContains(response, 'Oldname')
+
+    def test_conditional_get(self):
+        """Неизменившаяся страница отдается ответом 304 без рендера"""
+        url = reverse('posts:follow_index')
+        etag = self.auth_client.get(url)['ETag']
+        response = self.auth_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIsNone(response.context)
+        self.assertEqual(response.query_count, 0)
+        Post.objects.create(text='new', author=TestViews.author)
+        response = self.auth_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_stale_fragment_not_cached(self):
+        """Страница со старым фрагментом не кэшируется и идет без ETag"""
+        cache.clear()
+        url = reverse('posts:index')
+        self.client.get(url)
+        Post.objects.create(text='stale_check', author=TestViews.author)
+        lock_key = FRAGMENT_LOCK_KEY.format('index_page:page:1')
+        cache.add(lock_key, 1)
+        response = self.client.get(url)
+        self.assertNotIn(b'stale_check', response.content.lower())
+        self.assertFalse(response.has_header('ETag'))
+        self.assertIn('no-cache', response['Cache-Control'])
+        cache.delete(lock_key)
+        response = self.client.get(url)
+        self.assertIn(b'stale_check', response.content.lower())
+        self.assertTrue(response.has_header('ETag'))
 
     def test_vies_template(self):
         """URL-адрес использует соответствующий шаблон."""
@@ -207,6 +284,178 @@ class TestViews(TestCase):
         response = self.auth_client.get(reverse('posts:follow_index'))
         self.assertNotEqual(response.context['page_obj'], new_post)
 
+    def test_follow_index_timeline(self):
+        """Лента подписок заполняется при публикации и чистится
+        при отписке"""
+        reader = User.objects.create(username='reader')
+        reader_client = Client()
+        reader_client.force_login(reader)
+        reader_client.get(reverse(
+            'posts:profile_follow', kwargs={'username': TestViews.author}
+        ))
+        new_post = Post.objects.create(
+            text='Timeline post',
+            author=TestViews.author,
+        )
+        response = reader_client.get(reverse('posts:follow_index'))
+        page_obj = response.context['page_obj']
+        self.assertEqual(page_obj[0], new_post)
+        self.assertIn(TestViews.post, page_obj)
+
+        reader_client.get(reverse(
+            'posts:profile_unfollow', kwargs={'username': TestViews.author}
+        ))
+        self.assertFalse(TimelineEntry.objects.filter(user=reader).exists())
+
+    def test_follow_index_hybrid(self):
+        """Посты популярных авторов подмешиваются в ленту при чтении"""
+        reader = User.objects.create(username='reader')
+        star = User.objects.create(username='star')
+        reader_client = Client()
+        reader_client.force_login(reader)
+        Follow.objects.create(user=reader, author=TestViews.author)
+        Follow.objects.create(user=reader, author=star)
+        Follow.objects.create(user=TestViews.author, author=star)
+        Follow.objects.create(
+            user=User.objects.create(username='fan'), author=star
+        )
+        with override_settings(FANOUT_FOLLOWER_THRESHOLD=2):
+            cache.clear()
+            timeline.update_celebrities()
+            star_post = Post.objects.create(text='Star post', author=star)
+            self.assertFalse(
+                TimelineEntry.objects.filter(post=star_post).exists()
+            )
+            new_post = Post.objects.create(
+                text='Regular post', author=TestViews.author
+            )
+            self.assertTrue(
+                TimelineEntry.objects.filter(post=new_post).exists()
+            )
+            response = reader_client.get(reverse('posts:follow_index'))
+            with override_settings(POSTS_PAGINATION='cursor'):
+                cursor_response = reader_client.get(
+                    reverse('posts:follow_index')
+                )
+        expected = [new_post, star_post, TestViews.post]
+        self.assertEqual(list(response.context['page_obj']), expected)
+        self.assertEqual(list(cursor_response.context['page_obj']), expected)
+
+    def test_feed_fragment_hit_skips_feed_query(self):
+        """При попадании в кэш фрагмента посты ленты не читаются"""
+        feeds = {
+            reverse('posts:index'): '"posts_post"',
+            reverse('posts:follow_index'): '"posts_timelineentry"',
+        }
+        for pagination in ('page', 'cursor'):
+            for url, table in feeds.items():
+                with self.subTest(url=url, pagination=pagination), \
+                        override_settings(POSTS_PAGINATION=pagination):
+                    cache.clear()
+                    self.auth_client.get(url)
+                    with CaptureQueriesContext(connection) as queries:
+                        response = self.auth_client.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertFalse([
+                        query['sql'] for query in queries.captured_queries
+                        if f'FROM {table}' in query['sql']
+                    ])
+
+    def test_follow_index_former_celebrity(self):
+        """Посты, написанные автором в статусе популярного, попадают
+        в ленты подписчиков, когда он выпадает из этого статуса"""
+        reader = User.objects.create(username='reader')
+        reader_client = Client()
+        reader_client.force_login(reader)
+        star = User.objects.create(username='star')
+        for user in (reader, TestViews.author):
+            Follow.objects.create(user=user, author=star)
+        with override_settings(FANOUT_FOLLOWER_THRESHOLD=1):
+            self.assertEqual(timeline.update_celebrities(), (1, 0))
+            star_post = Post.objects.create(text='Star post', author=star)
+        self.assertFalse(
+            TimelineEntry.objects.filter(post=star_post).exists()
+        )
+        # Порог теперь выше, но чтение ленты ничего не пишет
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = reader_client.get(reverse('posts:follow_index'))
+        self.assertIn(star_post, response.context['page_obj'])
+        self.assertFalse([
+            query['sql'] for query in queries.captured_queries
+            if not query['sql'].startswith('SELECT')
+        ])
+        self.assertEqual(timeline.update_celebrities(), (0, 1))
+        self.assertEqual(timeline.celebrity_ids(), frozenset())
+        self.assertEqual(
+            TimelineEntry.objects.filter(post=star_post).count(), 2
+        )
+        self.assertIn(star_post, timeline.follow_feed(reader)[:10])
+
+    def test_follow_index_pages(self):
+        """Нумерованная страница ленты подписок - один OFFSET-запрос
+        на окно страницы, число постов - из счетчиков"""
+        reader = User.objects.create(username='reader')
+        reader_client = Client()
+        reader_client.force_login(reader)
+        Follow.objects.create(user=reader, author=TestViews.author)
+        posts = [
+            Post.objects.create(text=f'Page post {num}', author=self.author)
+            for num in range(NUM_PAGE_PAGINATOR + 2)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = reader_client.get(
+                reverse('posts:follow_index'), {'page': 2}
+            )
+        page_obj = response.context['page_obj']
+        self.assertEqual(page_obj.paginator.count, len(posts) + 1)
+        self.assertEqual(
+            list(page_obj), [posts[1], posts[0], TestViews.post]
+        )
+        timeline_sql = [
+            query['sql'] for query in queries.captured_queries
+            if 'posts_timelineentry' in query['sql']
+        ]
+        self.assertTrue(timeline_sql)
+        for sql in timeline_sql:
+            self.assertNotIn('COUNT', sql)
+            self.assertNotIn(f'LIMIT {2 * NUM_PAGE_PAGINATOR}', sql)
+
+    @override_settings(COMMENTS_PER_PAGE=3)
+    def test_post_comments_chunks(self):
+        """Комментарии отдаются порциями: первая в странице поста,
+        остальные - фрагментом"""
+        Comment.objects.bulk_create(
+            Comment(post=TestViews.post, author=TestViews.author,
+                    text=f'comment {num}')
+            for num in range(5)
+        )
+        response = self.auth_client.get(reverse(
+            'posts:post_detail', kwargs={'post_id': TestViews.post.id}
+        ))
+        first_chunk = response.context['comments']
+        self.assertEqual(len(first_chunk), 3)
+        self.assertTrue(first_chunk.has_next())
+
+        response = self.auth_client.get(
+            reverse('posts:post_comments',
+                    kwargs={'post_id': TestViews.post.id}),
+            {'after': first_chunk.next_cursor}
+        )
+        self.assertTemplateUsed(response, 'posts/includes/comments.html')
+        second_chunk = response.context['comments']
+        self.assertEqual(len(second_chunk), 2)
+        self.assertFalse(second_chunk.has_next())
+        self.assertFalse(
+            {c.pk for c in first_chunk} & {c.pk for c in second_chunk}
+        )
+
+    def test_post_comments_unknown_post(self):
+        response = self.auth_client.get(
+            reverse('posts:post_comments', kwargs={'post_id': 10 ** 6})
+        )
+        self.assertEqual(response.status_code, 404)
+
 
 class TestPaginatorViews(TestCase):
 
@@ -277,3 +526,306 @@ class TestPaginatorViews(TestCase):
                 len(response.context['page_obj']),
                 self.NUM_PAGE_2_PAGINATOR
             )
+
+    def test_index_cache_depends_on_page(self):
+        """Кэш главной страницы учитывает номер страницы"""
+        cache.clear()
+        url = reverse('posts:index')
+        first = self.auth_client.get(url).content
+        second = self.auth_client.get(url, {'page': 2}).content
+        self.assertNotEqual(first, second)
+
+    @override_settings(POSTS_PAGINATION='cursor')
+    def test_cursor_pages(self):
+        """Пагинация по курсору отдает страницы без пропусков и повторов"""
+        url = reverse('posts:group_list', kwargs={'slug': 'test-slug'})
+        response = self.auth_client.get(url)
+        first_page = response.context['page_obj']
+        self.assertTrue(first_page.is_cursor)
+        self.assertEqual(len(first_page), NUM_PAGE_PAGINATOR)
+        self.assertTrue(first_page.has_next())
+        self.assertFalse(first_page.has_previous())
+
+        response = self.auth_client.get(
+            url, {'after': first_page.next_cursor}
+        )
+        second_page = response.context['page_obj']
+        self.assertEqual(len(second_page), self.NUM_PAGE_2_PAGINATOR)
+        self.assertFalse(second_page.has_next())
+        self.assertTrue(second_page.has_previous())
+        ids = [post.id for post in first_page] + [
+            post.id for post in second_page
+        ]
+        self.assertEqual(
+            ids,
+            list(Post.objects.order_by('-created', '-id').values_list(
+                'id', flat=True
+            ))
+        )
+
+        response = self.auth_client.get(
+            url, {'before': second_page.previous_cursor}
+        )
+        self.assertEqual(
+            [post.id for post in response.context['page_obj']],
+            [post.id for post in first_page]
+        )
+
+
+class TestQueryBudget(QueryBudgetTestMixin, TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.group = Group.objects.create(
+            title='Test group',
+            slug='test-slug',
+            description='Test description',
+        )
+        cls.author = User.objects.create(username='korshikov')
+        cls.reader = User.objects.create(username='reader')
+        cls.auth_client = Client()
+        cls.auth_client.force_login(cls.reader)
+        Follow.objects.create(user=cls.reader, author=cls.author)
+        cls.post = Post.objects.create(
+            text='Test post', author=cls.author, group=cls.group
+        )
+        Comment.objects.create(
+            text='Comment', author=cls.reader, post=cls.post
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def count_queries(self, url):
+        # Без кэша фрагментов, чтобы шаблон действительно читал посты
+        cache.clear()
+        return self.get_query_count(self.auth_client, url)
+
+    def add_posts(self):
+        for num in range(5):
+            author = User.objects.create(username=f'author{num}')
+            Follow.objects.create(user=self.reader, author=author)
+            Post.objects.create(
+                text=f'Post {num}', author=author, group=self.group
+            )
+            Post.objects.create(
+                text=f'Author post {num}', author=self.author,
+                group=self.group
+            )
+            Comment.objects.create(
+                text=f'Comment {num}', author=author, post=self.post
+            )
+
+    def urls(self):
+        return (
+            reverse('posts:index'),
+            reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+            reverse('posts:profile', kwargs={'username': self.author}),
+            reverse('posts:post_detail', kwargs={'post_id': self.post.id}),
+            reverse('posts:follow_index'),
+            reverse('posts:post_comments', kwargs={'post_id': self.post.id}),
+            reverse('posts:api_index'),
+            reverse('posts:api_group_list', kwargs={'slug': self.group.slug}),
+            reverse('posts:api_profile', kwargs={'username': self.author}),
+            reverse('posts:api_follow_index'),
+        )
+
+    def test_cold_requests_within_budget(self):
+        """Сразу после миграции, с пустым кэшем, страницы укладываются
+        в бюджет: счетчики не создаются на GET-запросах"""
+        Counter.objects.all().delete()
+        counters.reconcile()
+        filled = Counter.objects.count()
+        for url in self.urls():
+            with self.subTest(url=url):
+                self.count_queries(url)
+        self.assertEqual(Counter.objects.count(), filled)
+
+    def test_feeds_constant_queries(self):
+        """Число запросов в лентах не зависит от числа постов"""
+        urls = self.urls()
+        for url in urls:
+            # Первый запрос прогревает кэши
+            self.auth_client.get(url)
+        counts = {url: self.count_queries(url) for url in urls}
+        self.add_posts()
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.count_queries(url), counts[url])
+
+
+class TestCachedLookups(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='reader')
+        self.client.force_login(self.user)
+
+    def test_group_lookup_cached(self):
+        """Группа берется из кэша, переименование сбрасывает ключ"""
+        group = Group.objects.create(title='Группа', slug='cached')
+        url = reverse('posts:group_list', kwargs={'slug': 'cached'})
+        self.client.get(url)
+        hits = lookups.stats()['hits']
+        self.assertContains(self.client.get(url), 'Группа')
+        self.assertEqual(lookups.stats()['hits'], hits + 1)
+        group.slug = 'renamed'
+        group.save()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_user_lookup_caches_public_fields(self):
+        """В кэш попадают только публичные поля пользователя"""
+        User.objects.filter(pk=self.user.pk).update(
+            first_name='Имя', email='reader@example.com'
+        )
+        url = reverse('posts:profile', kwargs={'username': 'reader'})
+        self.client.get(url)
+        cached = cache.get(lookups.lookup_key(User, 'username', 'reader'))
+        self.assertEqual(cached, (self.user.pk, 'reader', 'Имя', ''))
+        author = lookups.get_cached_or_404(User, 'username', 'reader')
+        self.assertEqual(author, self.user)
+        self.assertEqual(author.first_name, 'Имя')
+        self.assertContains(self.client.get(url), 'Имя')
+
+    def test_missing_user_cached(self):
+        """404 по username кэшируется до создания пользователя"""
+        url = reverse('posts:profile', kwargs={'username': 'newcomer'})
+        self.assertEqual(self.client.get(url).status_code, 404)
+        negative_hits = lookups.stats()['negative_hits']
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(lookups.stats()['negative_hits'], negative_hits + 1)
+        User.objects.create(username='newcomer')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class TestFeedFragmentCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_stale_value_while_recomputing(self):
+        """Пока фрагмент пересчитывает другой процесс, отдается старый"""
+        self.assertEqual(get_fragment('page', lambda: 'old'), 'old')
+        self.assertEqual(get_fragment('page', lambda: 'new'), 'old')
+        bump_feed_version()
+        stale_hits = fragment_stats()['stale_hits']
+        cache.add(FRAGMENT_LOCK_KEY.format('page'), 1)
+        self.assertEqual(get_fragment('page', lambda: 'new'), 'old')
+        self.assertEqual(fragment_stats()['stale_hits'], stale_hits + 1)
+        cache.delete(FRAGMENT_LOCK_KEY.format('page'))
+        self.assertEqual(get_fragment('page', lambda: 'new'), 'new')
+
+    @override_settings(FEED_CACHE_LOCK_TIMEOUT=0.1)
+    def test_waits_for_lock_without_stale_value(self):
+        """Без старого значения процесс ждет блокировку и считает сам"""
+        waits = fragment_stats()['waits']
+        cache.add(FRAGMENT_LOCK_KEY.format('page'), 1)
+        self.assertEqual(get_fragment('page', lambda: 'value'), 'value')
+        self.assertEqual(fragment_stats()['waits'], waits + 1)
+
+
+class TestFollowedIds(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create(username='followed')
+        self.reader = User.objects.create(username='follower')
+        self.other = User.objects.create(username='stranger')
+        Follow.objects.create(user=self.reader, author=self.author)
+        self.url = reverse('posts:profile', kwargs={'username': 'followed'})
+
+    def get_following(self, user):
+        client = Client()
+        client.force_login(user)
+        return client.get(self.url).context['following']
+
+    def test_following_depends_on_viewer(self):
+        """Флаг подписки на профиле зависит от того, кто смотрит"""
+        self.assertTrue(self.get_following(self.reader))
+        self.assertFalse(self.get_following(self.other))
+
+    def test_follow_set_invalidated(self):
+        """Подписка и отписка сбрасывают закэшированное множество"""
+        client = Client()
+        client.force_login(self.other)
+        self.assertFalse(client.get(self.url).context['following'])
+        client.get(
+            reverse('posts:profile_follow', kwargs={'username': 'followed'})
+        )
+        self.assertTrue(client.get(self.url).context['following'])
+        client.get(
+            reverse('posts:profile_unfollow', kwargs={'username': 'followed'})
+        )
+        self.assertFalse(client.get(self.url).context['following'])
+
+
+class TestApi(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create(username='author')
+        cls.reader = User.objects.create(username='reader')
+        Follow.objects.create(user=cls.reader, author=cls.author)
+        for num in range(NUM_PAGE_PAGINATOR + 3):
+            Post.objects.create(text=f'Post {num}', author=cls.author)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.reader)
+
+    def read_feed(self, url):
+        ids = []
+        response = self.client.get(url).json()
+        ids += [item['id'] for item in response['results']]
+        response = self.client.get(url, {'after': response['next']}).json()
+        ids += [item['id'] for item in response['results']]
+        self.assertIsNone(response['next'])
+        return ids
+
+    def test_feeds_pages(self):
+        """JSON-ленты отдают все посты по курсору без повторов"""
+        expected = list(Post.objects.order_by(
+            '-created', '-id'
+        ).values_list('id', flat=True))
+        for url in (
+            reverse('posts:api_index'),
+            reverse('posts:api_profile', kwargs={'username': 'author'}),
+            reverse('posts:api_follow_index'),
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.read_feed(url), expected)
+
+    def test_sparse_fields(self):
+        """?fields= оставляет в ответе только выбранные поля"""
+        url = reverse('posts:api_index')
+        item = self.client.get(url, {'fields': 'id,author'}).json()[
+            'results'
+        ][0]
+        self.assertEqual(set(item), {'id', 'author'})
+        self.assertEqual(item['author'], 'author')
+        response = self.client.get(url, {'fields': 'id,password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_follow_requires_login(self):
+        """Лента подписок без авторизации - 401"""
+        self.client.logout()
+        response = self.client.get(reverse('posts:api_follow_index'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_stats_for_staff(self):
+        """Статистика кэшей процесса видна только staff"""
+        url = reverse('posts:api_stats')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        User.objects.filter(pk=self.reader.pk).update(is_staff=True)
+        self.client.get(
+            reverse('posts:api_profile', kwargs={'username': 'author'})
+        )
+        stats = self.client.get(url).json()
+        self.assertIn('pid', stats)
+        self.assertGreaterEqual(stats['lookups']['misses'], 1)
+        self.assertEqual(
+            set(stats['fragments']),
+            {'recomputes', 'stale_hits', 'waits', 'wait_time'}
+        )
@@ -0,0 +1,168 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.signals import request_finished
+from django.db import connection
+from django.dispatch import receiver
+from PIL import features
+from sorl.thumbnail import delete, get_thumbnail
+
+from .storage import name_hash
+
+logger = logging.getLogger(__name__)
+
+# Ширины вариантов для srcset; пропорции обрезки как у 960x339
+WIDTHS = (320, 640, 960)
+HEIGHT_RATIO = 339 / 960
+# Первый формат - запасной для <img>, остальные - <source> в <picture>.
+# Pillow без libwebp не умеет WebP, тогда остается только JPEG.
+FORMATS = [('JPEG', 'image/jpeg')]
+if features.check('webp'):
+    FORMATS.append(('WEBP', 'image/webp'))
+
+THUMBNAILS = tuple(
+    (
+        f'{width}x{round(width * HEIGHT_RATIO)}',
+        {'crop': 'center', 'upscale': True, 'format': image_format},
+        width,
+        content_type,
+    )
+    for image_format, content_type in FORMATS
+    for width in WIDTHS
+)
+
+PICTURE_KEY = 'posts:picture:{}'
+
+_executor = None
+_pending = threading.local()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.THUMBNAIL_WORKERS,
+            thread_name_prefix='thumbnails'
+        )
+    return _executor
+
+
+def generate(name, content_hash=''):
+    """Создает все варианты картинки и записывает их в KV store sorl.
+
+    Готовый srcset кэшируется по хэшу содержимого.
+    """
+    if not default_storage.exists(name):
+        return
+    try:
+        picture = build_picture(name)
+    except Exception:
+        logger.exception('Не удалось создать миниатюры %s', name)
+        return
+    if content_hash:
+        cache.set(
+            PICTURE_KEY.format(content_hash), picture,
+            settings.PICTURE_CACHE_TIMEOUT
+        )
+
+
+def build_picture(name):
+    """Создает варианты картинки и возвращает данные для <picture>."""
+    srcsets = {}
+    for geometry, options, width, content_type in THUMBNAILS:
+        thumbnail = get_thumbnail(name, geometry, **options)
+        srcsets.setdefault(content_type, []).append(
+            f'{thumbnail.url} {width}w'
+        )
+    fallback_type = FORMATS[0][1]
+    fallback = srcsets.pop(fallback_type)
+    return {
+        'src': fallback[-1].rsplit(' ', 1)[0],
+        'srcset': ', '.join(fallback),
+        'sources': [
+            {'type': content_type, 'srcset': ', '.join(srcset)}
+            for content_type, srcset in srcsets.items()
+        ],
+    }
+
+
+def find_picture(name, content_hash=''):
+    """get_picture, который при ошибке пишет в лог и возвращает None.
+
+    Так ведет себя и тег {% thumbnail %} при THUMBNAIL_DEBUG = False.
+    """
+    try:
+        return get_picture(name, content_hash)
+    except Exception:
+        if getattr(settings, 'THUMBNAIL_DEBUG', False):
+            raise
+        logger.exception('Не удалось получить варианты %s', name)
+        return None
+
+
+def get_picture(name, content_hash=''):
+    """Данные для <picture>, закэшированные по хэшу содержимого.
+
+    Без хэша (старые посты) варианты берутся из KV store sorl.
+    """
+    if not content_hash:
+        return build_picture(name)
+    key = PICTURE_KEY.format(content_hash)
+    picture = cache.get(key)
+    if picture is None:
+        picture = build_picture(name)
+        cache.set(key, picture, settings.PICTURE_CACHE_TIMEOUT)
+    return picture
+
+
+def delete_image(name):
+    """Удаляет картинку вместе с ее миниатюрами, записями KV store
+    и закэшированным srcset."""
+    content_hash = name_hash(name)
+    if content_hash:
+        cache.delete(PICTURE_KEY.format(content_hash))
+    try:
+        delete(name)
+    except Exception:
+        logger.exception('Не удалось удалить картинку %s', name)
+
+
+def _generate_in_worker(name, content_hash):
+    try:
+        generate(name, content_hash)
+    finally:
+        # У потока пула свое соединение с БД (KV store sorl)
+        connection.close()
+
+
+def schedule(name, content_hash=''):
+    """Ставит картинку в очередь на создание миниатюр.
+
+    При THUMBNAIL_WORKERS = 0 миниатюры создаются сразу. Если воркер
+    не успел, тег {% picture %} создаст варианты при рендере.
+    """
+    if not settings.THUMBNAIL_WORKERS:
+        generate(name, content_hash)
+        return
+    future = get_executor().submit(_generate_in_worker, name, content_hash)
+    # Вне запроса (shell, команды) список не очищается сигналом
+    futures = [f for f in getattr(_pending, 'futures', ()) if not f.done()]
+    _pending.futures = futures + [future]
+
+
+@receiver(request_finished)
+def wait_for_thumbnails(sender, **kwargs):
+    """Дожидается миниатюр, заказанных запросом, уже после отправки ответа.
+
+    Пользователь не ждет, а процесс не берет новый запрос (и не
+    завершается), пока его миниатюры не готовы, поэтому работа
+    не теряется при перезапуске воркера.
+    """
+    futures = getattr(_pending, 'futures', None)
+    if futures:
+        _pending.futures = []
+        wait(futures, timeout=settings.THUMBNAIL_WAIT_TIMEOUT)
@@ -0,0 +1,276 @@
+import heapq
+from itertools import islice
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+from . import counters
+from .follows import followed_ids
+from .models import Celebrity, Follow, Post, TimelineEntry
+from .paginators import keyset_slice
+
+BATCH_SIZE = 1000
+CELEBRITIES_KEY = 'posts:celebrities'
+
+
+def celebrity_ids():
+    """Популярные авторы (модель Celebrity).
+
+    Их посты не раскладываются по лентам, а подмешиваются при чтении.
+    Список читается из кэша, а меняет его только update_celebrities.
+    """
+    ids = cache.get(CELEBRITIES_KEY)
+    if ids is None:
+        ids = frozenset(Celebrity.objects.values_list('author_id', flat=True))
+        cache.set(
+            CELEBRITIES_KEY, ids, settings.CELEBRITIES_CACHE_TIMEOUT
+        )
+    return ids
+
+
+def update_celebrities():
+    """Сверяет список популярных авторов со счетчиками подписчиков.
+
+    Популярными становятся авторы, у которых подписчиков больше
+    FANOUT_FOLLOWER_THRESHOLD. Выпавшим из списка ленты подписчиков
+    дозаполняются: до удаления из списка (пока посты подмешиваются
+    при чтении) и еще раз после - для постов, сохраненных между
+    заполнением и удалением. Возвращает пару (добавлено, убрано).
+    """
+    threshold = settings.FANOUT_FOLLOWER_THRESHOLD
+    wanted = (
+        set() if threshold is None
+        else counters.pks_above(counters.FOLLOWERS, threshold)
+    )
+    current = set(Celebrity.objects.values_list('author_id', flat=True))
+    added, removed = wanted - current, current - wanted
+    Celebrity.objects.bulk_create(
+        (Celebrity(author_id=author_id) for author_id in added),
+        ignore_conflicts=True
+    )
+    for author_id in removed:
+        fill_author(author_id)
+    Celebrity.objects.filter(author_id__in=removed).delete()
+    if added or removed:
+        cache.delete(CELEBRITIES_KEY)
+    for author_id in removed:
+        fill_author(author_id)
+    return len(added), len(removed)
+
+
+def _insert(entries):
+    """Вставляет записи пачками, не собирая весь список в памяти."""
+    entries = iter(entries)
+    while True:
+        batch = list(islice(entries, BATCH_SIZE))
+        if not batch:
+            break
+        TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def fan_out_post(post):
+    """Раскладывает новый пост по лентам подписчиков автора."""
+    if post.author_id in celebrity_ids():
+        return
+    follower_ids = Follow.objects.filter(
+        author_id=post.author_id
+    ).values_list('user_id', flat=True)
+    _insert(
+        TimelineEntry(user_id=user_id, post_id=post.pk, created=post.created)
+        for user_id in follower_ids.iterator()
+    )
+
+
+def add_author(user_id, author_id):
+    """Добавляет посты автора в ленту нового подписчика."""
+    if author_id in celebrity_ids():
+        return
+    posts = Post.objects.filter(author_id=author_id).values_list(
+        'pk', 'created'
+    )
+    _insert(
+        TimelineEntry(user_id=user_id, post_id=pk, created=created)
+        for pk, created in posts.iterator()
+    )
+
+
+def fill_author(author_id):
+    """Раскладывает посты популярного автора по лентам всех его
+    подписчиков: пока он был популярным, fan-out не делался.
+
+    Уже разложенные посты пропускаются (ignore_conflicts).
+    """
+    posts = list(Post.objects.filter(author_id=author_id).values_list(
+        'pk', 'created'
+    ))
+    follower_ids = Follow.objects.filter(
+        author_id=author_id
+    ).values_list('user_id', flat=True)
+    _insert(
+        TimelineEntry(user_id=user_id, post_id=pk, created=created)
+        for user_id in follower_ids.iterator()
+        for pk, created in posts
+    )
+
+
+def remove_author(user_id, author_id):
+    """Убирает посты автора из ленты после отписки."""
+    TimelineEntry.objects.filter(
+        user_id=user_id, post__author_id=author_id
+    ).delete()
+
+
+def rebuild(user_ids=None):
+    """Пересобирает ленты с нуля по таблице подписок.
+
+    Возвращает число подписок, по которым заполнены ленты.
+    """
+    follows = Follow.objects.all()
+    entries = TimelineEntry.objects.all()
+    if user_ids is not None:
+        follows = follows.filter(user_id__in=user_ids)
+        entries = entries.filter(user_id__in=user_ids)
+    entries.delete()
+    count = 0
+    follows = follows.exclude(author_id__in=celebrity_ids())
+    for user_id, author_id in follows.values_list(
+        'user_id', 'author_id'
+    ).iterator():
+        add_author(user_id, author_id)
+        count += 1
+    return count
+
+
+class MergedFeed:
+    """k-way слияние лент, отсортированных по (created, pk) по убыванию.
+
+    Каждый поток - пара (queryset, pk_field). Строки TimelineEntry
+    превращаются в посты, а у словарей из .values() pk_field
+    становится 'id'; пост, попавший в несколько потоков,
+    отдается один раз. Для окна из limit записей из каждого потока
+    читается не больше limit строк.
+
+    Для нумерованных страниц count - функция, возвращающая число
+    постов (например, по счетчикам), а posts - выборка, из которой
+    загружаются посты окна: из нескольких потоков тогда читаются
+    только ключи, а объекты строятся лишь для постов страницы.
+    """
+
+    def __init__(self, *streams, count=None, posts=None):
+        self.streams = streams
+        self._count = count
+        self.posts = posts
+
+    def count(self):
+        if self._count is not None:
+            return self._count()
+        return sum(queryset.count() for queryset, _ in self.streams)
+
+    @staticmethod
+    def _post(row, pk_field):
+        if isinstance(row, dict):
+            # Словарь из .values(): ключ ленты всегда 'id'
+            row['id'] = row.pop(pk_field)
+            return row
+        return row.post if isinstance(row, TimelineEntry) else row
+
+    def keyset_slice(self, key=None, newer=False, limit=None):
+        def keyed(queryset, pk_field):
+            for row in keyset_slice(queryset, pk_field, key, newer, limit):
+                if isinstance(row, dict):
+                    position = (row['created'], row[pk_field])
+                else:
+                    position = (row.created, getattr(row, pk_field))
+                yield position, self._post(row, pk_field)
+
+        merged = heapq.merge(
+            *(keyed(*stream) for stream in self.streams),
+            key=lambda item: item[0],
+            reverse=not newer
+        )
+        posts = []
+        seen = set()
+        for (_, pk), post in merged:
+            if pk in seen:
+                continue
+            seen.add(pk)
+            posts.append(post)
+            if limit is not None and len(posts) == limit:
+                break
+        return posts
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self._slice(slice(item, item + 1))[0]
+        # Страница читается при первом обращении, как срез QuerySet:
+        # при попадании в кэш фрагмента ленты запроса нет
+        return SimpleLazyObject(lambda: self._slice(item))
+
+    def _slice(self, item):
+        if len(self.streams) == 1:
+            # Один поток - обычный OFFSET по индексу, без слияния
+            queryset, pk_field = self.streams[0]
+            rows = queryset.order_by('-created', f'-{pk_field}')[item]
+            return [self._post(row, pk_field) for row in rows]
+        if self.posts is None:
+            return self.keyset_slice(limit=item.stop)[item]
+        keys = MergedFeed(*(
+            (queryset.values('created', pk_field), pk_field)
+            for queryset, pk_field in self.streams
+        )).keyset_slice(limit=item.stop)[item]
+        ids = [row['id'] for row in keys]
+        posts = self.posts.in_bulk(ids)
+        return [posts[pk] for pk in ids if pk in posts]
+
+
+def followed_celebrities(user):
+    """Популярные авторы из подписок: их посты не раскладываются."""
+    celebrities = celebrity_ids()
+    if not celebrities:
+        return []
+    return list(celebrities & followed_ids(user.pk))
+
+
+def follow_feed(user):
+    """Лента подписок: материализованная лента пользователя плюс
+    свежие посты популярных авторов, подмешанные при чтении.
+
+    Число постов ленты - сумма счетчиков постов авторов из подписок.
+    """
+    posts = Post.objects.select_related('group', 'author')
+    entries = TimelineEntry.objects.select_related(
+        'post__group', 'post__author'
+    ).filter(user=user)
+    streams = [(entries, 'post_id')]
+    followed = followed_celebrities(user)
+    if followed:
+        streams.append((posts.filter(author_id__in=followed), 'id'))
+    return MergedFeed(
+        *streams,
+        count=lambda: sum(counters.get_counts(
+            counters.AUTHOR_POSTS, followed_ids(user.pk)
+        ).values()),
+        posts=posts
+    )
+
+
+def follow_feed_keys(user):
+    """Та же лента подписок, но только ключами: словари
+    {'created', 'id'} из .values(), без объектов моделей."""
+    streams = [(
+        TimelineEntry.objects.filter(user=user).values('created', 'post_id'),
+        'post_id'
+    )]
+    followed = followed_celebrities(user)
+    if followed:
+        streams.append((
+            Post.objects.filter(
+                author_id__in=followed
+            ).values('created', 'id'),
+            'id'
+        ))
+    return MergedFeed(*streams)
@@ -3,58 +3,135 @@ from .models import Group, Post, User, Comment, Follow
 from django.core.paginator import Paginator
 from .forms import PostForm, CommentForm
 from django.contrib.auth.decorators import login_required
+from django.conf import settings
+from core.query_budget import query_budget
 from yatube.settings import NUM_PAGE_PAGINATOR
-
-
-def paginator(request, posts):
-    paginator = Paginator(posts, NUM_PAGE_PAGINATOR)
+from .paginators import (
+    CountedPaginator, CursorPaginator, CURSOR_AFTER, CURSOR_BEFORE
+)
+from . import counters
+from .cache import cache_anonymous_page, feed_cache_context, feed_condition
+from .follows import get_followed_ids
+from .lookups import get_cached_or_404
+from .timeline import follow_feed
+
+
+def paginator(request, posts, pk_field='id', count=None):
+    """Постраничный вывод ленты.
+
+    По умолчанию страницы нумеруются (?page=N). Если в запросе есть
+    курсор (?after=... / ?before=...) или включен режим
+    POSTS_PAGINATION = 'cursor', используется пагинация по ключу.
+    count - число записей из счетчика, чтобы не считать строки.
+    """
+    after = request.GET.get(CURSOR_AFTER)
+    before = request.GET.get(CURSOR_BEFORE)
+    cursor_mode = getattr(settings, 'POSTS_PAGINATION', 'page') == 'cursor'
+    if after or before or cursor_mode:
+        return CursorPaginator(
+            posts, NUM_PAGE_PAGINATOR, pk_field=pk_field
+        ).get_page(after=after, before=before)
+    if count is None:
+        paginator = Paginator(posts, NUM_PAGE_PAGINATOR)
+    else:
+        paginator = CountedPaginator(posts, NUM_PAGE_PAGINATOR, count)
     page_number = request.GET.get('page')
     return paginator.get_page(page_number)
 
 
+def comments_page(post_id, after=None):
+    """Порция комментариев поста по курсору, авторы - тем же запросом."""
+    comments = Comment.objects.select_related('author').filter(
+        post_id=post_id
+    )
+    return CursorPaginator(comments, settings.COMMENTS_PER_PAGE).get_page(
+        after=after
+    )
+
+
+@query_budget(6)
+@feed_condition
+@cache_anonymous_page
 def index(request):
-    posts = Post.objects.select_related('group')
+    posts = Post.objects.select_related('group', 'author')
     context = {
-        'page_obj': paginator(request, posts)
+        'page_obj': paginator(
+            request, posts, count=counters.get_count(counters.POSTS)
+        ),
+        **feed_cache_context(request),
     }
     return render(request, 'posts/index.html', context)
 
 
+@query_budget(7)
+@feed_condition
+@cache_anonymous_page
 def group_posts(request, slug):
-    group = get_object_or_404(Group, slug=slug)
-    posts = group.post.all()
+    group = get_cached_or_404(Group, 'slug', slug)
+    posts = group.post.select_related('author')
+    posts_count = counters.get_count(counters.GROUP_POSTS, group.pk)
     context = {
-        'page_obj': paginator(request, posts),
+        'page_obj': paginator(request, posts, count=posts_count),
         'group': group
     }
     return render(request, 'posts/group_list.html', context)
 
 
+@query_budget(10)
+@feed_condition
+@cache_anonymous_page
 def profile(request, username):
-    author = get_object_or_404(User, username=username)
-    posts = author.posts.all()
+    author = get_cached_or_404(User, 'username', username)
+    posts = author.posts.select_related('group')
+    posts_count, followers_count, following_count = counters.get_values(
+        (counters.AUTHOR_POSTS, author.pk),
+        (counters.FOLLOWERS, author.pk),
+        (counters.FOLLOWING, author.pk),
+    )
 
-    following = Follow.objects.filter(author=author).exists()
+    following = author.pk in get_followed_ids(request)
     context = {'author': author,
-               'page_obj': paginator(request, posts),
-               'posts': posts,
+               'page_obj': paginator(request, posts, count=posts_count),
+               'posts_count': posts_count,
+               'followers_count': followers_count,
+               'following_count': following_count,
                'following': following
                }
     return render(request, 'posts/profile.html', context)
 
 
+@query_budget(7)
+@feed_condition
+@cache_anonymous_page
 def post_detail(request, post_id):
-    post = get_object_or_404(Post, pk=post_id)
+    post = get_object_or_404(
+        Post.objects.select_related('group', 'author'), pk=post_id
+    )
     form = CommentForm()
-    comment = Comment.objects.filter(post=post)
     context = {
         'posts': post,
         'form': form,
-        'comments': comment
+        'comments': comments_page(post.pk),
+        'author_posts_count': counters.get_count(
+            counters.AUTHOR_POSTS, post.author_id
+        ),
     }
     return render(request, 'posts/post_detail.html', context)
 
 
+@query_budget(3)
+def post_comments(request, post_id):
+    """Следующая порция комментариев HTML-фрагментом для post_detail."""
+    comments = comments_page(post_id, request.GET.get(CURSOR_AFTER))
+    if not comments.object_list:
+        get_object_or_404(Post, pk=post_id)
+    context = {
+        'comments': comments,
+        'post_id': post_id,
+    }
+    return render(request, 'posts/includes/comments.html', context)
+
+
 @login_required
 def post_create(request):
     form = PostForm(request.POST, request.FILES)
@@ -108,22 +185,26 @@ def add_comment(request, post_id):
 
 # posts/views.py
 
+# С пустым кэшем и популярными авторами в подписках: их список,
+# подписки, счетчики, ключи двух потоков и посты страницы
 @login_required
+@query_budget(6)
+@feed_condition
 def follow_index(request):
-    posts = Post.objects.select_related(
-        'group'
-    ).filter(author__following__user=request.user)
+    # Лента подписок заранее разложена по TimelineEntry при публикации;
+    # посты авторов с большим числом подписчиков подмешиваются при чтении
+    page_obj = paginator(request, follow_feed(request.user))
 
     context = {
-        'posts': posts,
-        'page_obj': paginator(request, posts),
+        'page_obj': page_obj,
+        **feed_cache_context(request, request.user.pk),
     }
     return render(request, 'posts/follow.html', context)
 
 
 @login_required
 def profile_follow(request, username):
-    author = get_object_or_404(User, username=username)
+    author = get_cached_or_404(User, 'username', username)
     if request.user != author:
         Follow.objects.get_or_create(
             user=request.user,
@@ -134,7 +215,7 @@ def profile_follow(request, username):
 
 @login_required
 def profile_unfollow(request, username):
-    author = get_object_or_404(User, username=username)
+    author = get_cached_or_404(User, 'username', username)
     # Дизлайк, отписка
     Follow.objects.filter(author=author, user=request.user).delete()
     return redirect('posts:profile', username=username)
@@ -59,6 +59,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'core.context_processors.year.year',
+                'core.context_processors.follows.followed_ids',
             ],
         },
     },
@@ -124,10 +125,81 @@ CSRF_FAILURE_VIEW = 'core.views.csrf_failure'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Память процесса перед SQLite-файлом, общим для всех воркеров узла:
+# ленты, поиск групп и пользователей, srcset картинок
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'BACKEND': 'core.cache.TwoTierCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache.sqlite3'),
+        'OPTIONS': {
+            'L1_MAX_ENTRIES': 1000,
+            # Журнал изменений других процессов читается не чаще
+            # раза в столько секунд
+            'SYNC_INTERVAL': 0.01,
+        },
     }
 }
 
 NUM_PAGE_PAGINATOR = 10
+# 'page' - нумерованные страницы, 'cursor' - пагинация по (created, id)
+POSTS_PAGINATION = 'page'
+# Комментарии на странице поста подгружаются порциями
+COMMENTS_PER_PAGE = 20
+# Фрагменты лент живут до изменения постов, но не дольше этого срока
+FEED_CACHE_TIMEOUT = 60 * 60
+# Сколько устаревший фрагмент отдается, пока его пересчитывает другой
+# процесс, и насколько этот процесс блокирует пересчет
+FEED_CACHE_GRACE = 60
+FEED_CACHE_LOCK_TIMEOUT = 10
+# Целые страницы для анонимных читателей, сбрасываются так же
+PAGE_CACHE_TIMEOUT = 60 * 60
+# Группы и пользователи по slug и username; «не найден» - недолго
+LOOKUP_CACHE_TIMEOUT = 60 * 60
+LOOKUP_NEGATIVE_CACHE_TIMEOUT = 60
+# Множество подписок пользователя, сбрасывается при подписке и отписке
+FOLLOWS_CACHE_TIMEOUT = 60 * 60
+
+# Посты авторов, у которых подписчиков больше порога, не раскладываются
+# по лентам подписчиков, а подмешиваются при чтении. None - всегда fan-out.
+# Список авторов по порогу обновляет команда update_celebrities (по cron).
+FANOUT_FOLLOWER_THRESHOLD = 10000
+CELEBRITIES_CACHE_TIMEOUT = 60 * 5
+
+# Превышение бюджета SQL-запросов view (core.query_budget):
+# False - предупреждение в лог, True - исключение
+QUERY_BUDGET_RAISE = False
+
+# Потоки, создающие миниатюры картинок после сохранения поста.
+# 0 - создавать сразу, в потоке запроса.
+THUMBNAIL_WORKERS = 2
+# Сколько секунд после ответа процесс ждет заказанные запросом миниатюры
+THUMBNAIL_WAIT_TIMEOUT = 30
+# Готовый srcset картинки по хэшу содержимого; удаление картинки
+# сбрасывает его сразу, а срок - страховка для старых имен без хэша
+PICTURE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# Метаданные миниатюр: LRU в памяти процесса перед локальным SQLite-файлом
+THUMBNAIL_KVSTORE = 'core.kvstore.TieredKVStore'
+THUMBNAIL_KVSTORE_PATH = os.path.join(BASE_DIR, 'thumbnail_kvstore.sqlite3')
+THUMBNAIL_KVSTORE_LRU_SIZE = 10000
+# Сколько последних изменений хранит журнал, по которому процессы
+# сбрасывают свою память
+THUMBNAIL_KVSTORE_CHANGES_KEPT = 10000
+# Как часто процесс проверяет этот журнал, секунд
+THUMBNAIL_KVSTORE_SYNC_INTERVAL = 0.01
+
+# Загружаемые картинки: большая сторона уменьшается до IMAGE_MAX_SIZE,
+# больше IMAGE_MAX_PIXELS пикселей - отказ (защита от «бомб»)
+IMAGE_MAX_SIZE = 2048
+IMAGE_MAX_PIXELS = 40_000_000
+# Качество JPEG и WebP при перекодировании
+IMAGE_QUALITY = 85
+
+# Медиафайлы отдает core.media.serve. Имена картинок строятся по хэшу
+# содержимого, поэтому браузер может кэшировать их надолго.
+MEDIA_CACHE_MAX_AGE = 60 * 60 * 24 * 365
+# None - файл отдает Django; 'x-sendfile' (Apache, lighttpd) или
+# 'x-accel-redirect' (nginx) - файл отдает фронтовой сервер
+MEDIA_SENDFILE = None
+# internal-location nginx, смотрящий в MEDIA_ROOT
+MEDIA_ACCEL_PREFIX = '/protected-media/'